@@ -5,12 +5,18 @@ from aws_cdk import core as cdk
 
 from blueprint_pipelines.controls_pipeline_stack import ControlsPipelineStack
 from blueprint_pipelines.application_pipeline_stack import ApplicationPipelineStack
+from blueprint_pipelines.synth_profiler import SynthProfiler
 
 CONTROLS_PIPELINE_NAME = "ControlsFoundationControlsPipeline"
 APPLICATION_PIPELINE_NAME = "ControlsFoundationApplicationPipeline"
 
 app = cdk.App()
 
+# Profiles the synth into the file given with -c synthProfile=<file>
+profiler = SynthProfiler.from_context(
+    app, [ControlsPipelineStack, ApplicationPipelineStack]
+)
+
 common_env = cdk.Environment(
     account=os.environ.get("CDK_DEFAULT_ACCOUNT"),
     region=os.environ.get("CDK_DEFAULT_REGION"),
@@ -58,4 +64,6 @@ if (
         env=common_env,
     )
 
-app.synth()
\ No newline at end of file
+with profiler.timed("app.synth"):
+    app.synth()
+profiler.report(app)
@@ -22,6 +22,8 @@ REPO_OPA_EVAL_SCRIPT_PATH = "blueprint_pipelines/controls_scripts/opa_eval.py"
 REPO_OPA_CFN_TEMPL_OPA_POLICIES_DIR = (
     "blueprint_pipelines/controls_scripts/cfn_template_opa_policies"
 )
+# Kept between builds by the OPA check project's local CodeBuild cache
+OPA_EVAL_CACHE_DIR = ".opa_eval_cache"
 
 logger = logging.getLogger(__name__)
 
@@ -171,12 +173,14 @@ class ApplicationPipelineStack(cdk.Stack, PipelineMixin):
                         },
                         "build": {
                             "commands": [
-                                f"{REPO_OPA_EVAL_SCRIPT_PATH} {REPO_OPA_CFN_TEMPL_OPA_POLICIES_DIR} $CODEBUILD_SRC_DIR_Artifact_BuildApplication_CdkSynth/cdk.out/*.template.json",
+                                f"{REPO_OPA_EVAL_SCRIPT_PATH} --batch --jobs $(nproc) --cache-dir {OPA_EVAL_CACHE_DIR} --baseline-dir {OPA_EVAL_CACHE_DIR}/baseline {REPO_OPA_CFN_TEMPL_OPA_POLICIES_DIR} $CODEBUILD_SRC_DIR_Artifact_BuildApplication_CdkSynth/cdk.out/*.template.json",
                             ],
                         },
                     },
+                    "cache": {"paths": [f"{OPA_EVAL_CACHE_DIR}/**/*"]},
                 }
             ),
+            cache=aws_codebuild.Cache.local(aws_codebuild.LocalCacheMode.CUSTOM),
         )
         self.automated_controls_stage.add_actions(
             aws_codepipeline_actions.CodeBuildAction(
@@ -1,9 +1,18 @@
+import hashlib
+import json
 import os
+import shutil
+import subprocess
+import tempfile
 from pathlib import Path
 
+import jsii
 from aws_cdk import (
     aws_config,
+    aws_dynamodb,
+    aws_iam,
     aws_s3_assets,
+    aws_sqs,
     core as cdk,
     aws_lambda,
     aws_lambda_python,
@@ -14,18 +23,145 @@ SCRIPTS_DIR = os.path.join(CURRENT_DIR, "controls_scripts")
 CONTROL_BROKER_OPA_LAMBDA_LAYER_DIR = os.path.join(
     SCRIPTS_DIR, "lambdas/control_broker_opa_layer"
 )
+# Only the wasm engine imports wasmtime, so only its function gets the layer
+CONTROL_BROKER_WASM_LAYER_DIR = os.path.join(
+    SCRIPTS_DIR, "lambdas/control_broker_wasm_layer"
+)
 CONTROL_BROKER_LAMBDA_ENTRY_DIR = os.path.join(
     SCRIPTS_DIR, "lambdas/control_broker_opa_lambda"
 )
 CONTROL_BROKER_LAMBDA_INDEX_FILENAME = "control-broker-opa-lambda.py"
 CONTROL_BROKER_LAMBDA_HANDLE_NAME = "lambda_handler"
+CONTROL_BROKER_ENQUEUE_HANDLE_NAME = "enqueue_handler"
+# Should match the OPA binary in the Control Broker OPA layer
+OPA_VERSION = "0.32.1"
+OPA_DOCKER_IMAGE = f"openpolicyagent/opa:{OPA_VERSION}"
+OPA_WASM_BUNDLE_FILENAME = "bundle.tar.gz"
+POLICY_BUNDLE_INDEX_FILENAME = "index.json"
+POLICY_BUNDLE_POLICIES_DIR = "policies"
+# Index key of the policies that apply to every resource type
+POLICY_BUNDLE_ALL_RESOURCE_TYPES = "*"
+# Receives of a queued event before it goes to the dead letter queue, also
+# passed to the Lambda
+QUEUE_MAX_RECEIVE_COUNT = 5
+# Lambda environment variables are limited to 4 KB in total, of which
+# PRIME_POLICIES may take this much. Rules past it aren't primed.
+PRIME_POLICIES_MAX_BYTES = 3072
+# Unresolved tokens in the rule parameters, such as asset bucket names and
+# object keys, are counted at this length when sizing PRIME_POLICIES
+TOKEN_MAX_RESOLVED_LENGTH = 160
+
+
+def prime_policies_size(prime_policies: list) -> int:
+    """Return the size PRIME_POLICIES could take once deployed."""
+    size = len(json.dumps(prime_policies, separators=(",", ":")))
+    for rule_parameters in prime_policies:
+        for value in rule_parameters.values():
+            if cdk.Token.is_unresolved(value):
+                size += TOKEN_MAX_RESOLVED_LENGTH - len(value)
+    return size
+
+
+def opa_wasm_build_command(entrypoint: str, policy_file_path: str, output_dir: str):
+    return [
+        "build",
+        "-t",
+        "wasm",
+        "-e",
+        entrypoint,
+        "-o",
+        os.path.join(output_dir, OPA_WASM_BUNDLE_FILENAME),
+        policy_file_path,
+    ]
+
+
+@jsii.implements(cdk.ILocalBundling)
+class OpaWasmLocalBundling:
+    """Compiles a rego policy to Wasm with a local opa binary, if there is one,
+    instead of the OPA Docker image."""
+
+    def __init__(self, rego_policy_file_path: Path, entrypoint: str) -> None:
+        self.rego_policy_file_path = rego_policy_file_path
+        self.entrypoint = entrypoint
+
+    def try_bundle(self, output_dir: str, options: cdk.BundlingOptions) -> bool:
+        opa_binary_path = shutil.which("opa")
+        if opa_binary_path is None:
+            return False
+        subprocess.run(
+            [opa_binary_path]
+            + opa_wasm_build_command(
+                self.entrypoint, str(self.rego_policy_file_path), output_dir
+            ),
+            check=True,
+        )
+        return True
 
 
 class ControlBroker(cdk.Construct):
     REGO_POLICIES_PREFIX = "rego_policies"
 
-    def __init__(self, scope: cdk.Construct, id: str) -> None:
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        policy_cache_ttl: cdk.Duration = cdk.Duration.minutes(5),
+        opa_engine: str = "server",
+        prime_on_init: bool = True,
+        bundled: bool = False,
+        verdict_cache: str = "memory",
+        verdict_cache_ttl: cdk.Duration = cdk.Duration.days(1),
+        timeout: cdk.Duration = cdk.Duration.seconds(30),
+        queue_buffered: bool = False,
+        queue_batch_size: int = 100,
+        queue_max_batching_window: cdk.Duration = cdk.Duration.seconds(5),
+        log_level: str = "INFO",
+    ) -> None:
+        """policy_cache_ttl is how long a warm Lambda reuses a downloaded rego
+        policy before revalidating it against S3.
+
+        opa_engine is "server" to evaluate policies with an OPA server kept
+        running across warm invocations, "wasm" to compile them to Wasm at
+        synth time and evaluate them in-process, or "subprocess" to run
+        `opa eval` for every evaluation.
+
+        prime_on_init makes each new Lambda execution environment load the
+        policies of every rule and warm the OPA engine before its first
+        invocation. The rules are primed in the order they are added, until
+        PRIME_POLICIES would exceed PRIME_POLICIES_MAX_BYTES, and a warning
+        is added for the rest.
+
+        In bundled mode, add_opa_rule only registers the policies and
+        add_policy_bundle_rule then creates a single Config rule evaluating
+        all of them, routed by resource type.
+
+        verdict_cache is where verdicts are memoized by configuration item
+        fingerprint and policy version: "memory" for each execution
+        environment, "dynamodb" for a table shared by all of them, where they
+        expire after verdict_cache_ttl, or "none".
+
+        timeout is the Lambda timeout. Periodic sweeps that don't finish in
+        time continue in a new invocation, so a longer timeout only means
+        fewer of them.
+
+        With queue_buffered, Config invokes a small function that only
+        forwards each event to an SQS queue, and the Control Broker function
+        evaluates the queue in batches of up to queue_batch_size events,
+        waiting up to queue_max_batching_window to fill them. Repeated events
+        for a resource are merged and only the failed events of a batch are
+        retried, up to QUEUE_MAX_RECEIVE_COUNT times before going to a dead
+        letter queue.
+
+        log_level is the level of the Lambda's logs. Configuration items and
+        events are only logged at DEBUG."""
         super().__init__(scope, id)
+        if bundled and opa_engine == "wasm":
+            raise ValueError("The wasm engine does not support bundled mode")
+        self.opa_engine = opa_engine
+        self.bundled = bundled
+        self.bundled_policies = {}
+        self.prime_on_init = prime_on_init
+        self.prime_policies = []
         self.opa_lambda = aws_lambda_python.PythonFunction(
             self,
             "ControlBrokerLambdaFunction",
@@ -33,17 +169,128 @@ class ControlBroker(cdk.Construct):
             index=CONTROL_BROKER_LAMBDA_INDEX_FILENAME,
             handler=CONTROL_BROKER_LAMBDA_HANDLE_NAME,
             runtime=aws_lambda.Runtime.PYTHON_3_8,
-            timeout=cdk.Duration.seconds(30)
+            timeout=timeout,
+            environment={
+                "POLICY_CACHE_TTL_SECONDS": str(policy_cache_ttl.to_seconds()),
+                "OPA_ENGINE": opa_engine,
+                "PRIME_ON_INIT": str(prime_on_init).lower(),
+                "VERDICT_CACHE_BACKEND": verdict_cache,
+                "VERDICT_CACHE_TTL_SECONDS": str(verdict_cache_ttl.to_seconds()),
+                "LOG_LEVEL": log_level,
+            },
         )
-        self.opa_layer = aws_lambda.LayerVersion(
+        # Sweeps invoke the function again to continue. The statement is in a
+        # separate policy, since one on the function's own ARN in its role's
+        # default policy would make a dependency cycle.
+        aws_iam.Policy(
             self,
-            "OpaLambdaLayer",
-            compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_8],
-            layer_version_name="opa-layer",
-            description="OPA binary for custom config rules lambda (from the Control Foundations Blueprint)",
-            code=aws_lambda.Code.from_asset(CONTROL_BROKER_OPA_LAMBDA_LAYER_DIR),
+            "SweepContinuationPolicy",
+            statements=[
+                aws_iam.PolicyStatement(
+                    actions=["lambda:InvokeFunction"],
+                    resources=[self.opa_lambda.function_arn],
+                )
+            ],
+            roles=[self.opa_lambda.role],
         )
-        self.opa_lambda.add_layers(self.opa_layer)
+        self.verdict_cache_table = None
+        if verdict_cache == "dynamodb":
+            self.verdict_cache_table = aws_dynamodb.Table(
+                self,
+                "VerdictCacheTable",
+                partition_key=aws_dynamodb.Attribute(
+                    name="fingerprint", type=aws_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="expires_at",
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+            self.verdict_cache_table.grant_read_write_data(self.opa_lambda)
+            self.opa_lambda.add_environment(
+                "VERDICT_CACHE_TABLE", self.verdict_cache_table.table_name
+            )
+        # The wasm engine doesn't run the OPA binary, so its cold starts
+        # don't need to load the layer
+        self.opa_layer = None
+        if opa_engine != "wasm":
+            self.opa_layer = aws_lambda.LayerVersion(
+                self,
+                "OpaLambdaLayer",
+                compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_8],
+                layer_version_name="opa-layer",
+                description="OPA binary for custom config rules lambda (from the Control Foundations Blueprint)",
+                code=aws_lambda.Code.from_asset(CONTROL_BROKER_OPA_LAMBDA_LAYER_DIR),
+            )
+            self.opa_lambda.add_layers(self.opa_layer)
+        self.wasm_layer = None
+        if opa_engine == "wasm":
+            self.wasm_layer = aws_lambda_python.PythonLayerVersion(
+                self,
+                "WasmtimeLambdaLayer",
+                entry=CONTROL_BROKER_WASM_LAYER_DIR,
+                compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_8],
+                description="wasmtime for the Control Broker wasm engine (from the Control Foundations Blueprint)",
+            )
+            self.opa_lambda.add_layers(self.wasm_layer)
+        # The function Config rules invoke
+        self.rule_lambda = self.opa_lambda
+        self.queue = None
+        if queue_buffered:
+            self.add_queue(timeout, queue_batch_size, queue_max_batching_window)
+
+    def add_queue(
+        self,
+        timeout: cdk.Duration,
+        batch_size: int,
+        max_batching_window: cdk.Duration,
+    ):
+        self.dead_letter_queue = aws_sqs.Queue(self, "ControlBrokerDeadLetterQueue")
+        # AWS recommends a visibility timeout of six times the function timeout
+        self.queue = aws_sqs.Queue(
+            self,
+            "ControlBrokerQueue",
+            visibility_timeout=cdk.Duration.seconds(6 * timeout.to_seconds()),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=QUEUE_MAX_RECEIVE_COUNT,
+                queue=self.dead_letter_queue,
+            ),
+        )
+        event_source_mapping = aws_lambda.EventSourceMapping(
+            self,
+            "ControlBrokerQueueEventSourceMapping",
+            target=self.opa_lambda,
+            event_source_arn=self.queue.queue_arn,
+            batch_size=batch_size,
+            max_batching_window=max_batching_window,
+        )
+        # Not exposed by this version of aws_lambda.EventSourceMapping
+        event_source_mapping.node.default_child.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"]
+        )
+        self.queue.grant_consume_messages(self.opa_lambda)
+        self.opa_lambda.add_environment(
+            "QUEUE_MAX_RECEIVE_COUNT", str(QUEUE_MAX_RECEIVE_COUNT)
+        )
+        # Config rules only grant config:PutEvaluations to the function they
+        # invoke, which is now the enqueue function
+        self.opa_lambda.role.add_managed_policy(
+            aws_iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSConfigRulesExecutionRole"
+            )
+        )
+        self.rule_lambda = aws_lambda_python.PythonFunction(
+            self,
+            "ControlBrokerEnqueueFunction",
+            entry=CONTROL_BROKER_LAMBDA_ENTRY_DIR,
+            index=CONTROL_BROKER_LAMBDA_INDEX_FILENAME,
+            handler=CONTROL_BROKER_ENQUEUE_HANDLE_NAME,
+            runtime=aws_lambda.Runtime.PYTHON_3_8,
+            environment={
+                "QUEUE_URL": self.queue.queue_url,
+                "PRIME_ON_INIT": "false",
+            },
+        )
+        self.queue.grant_send_messages(self.rule_lambda)
 
     def add_opa_rule(
         self,
@@ -54,24 +301,180 @@ class ControlBroker(cdk.Construct):
         opa_policy_package_name: str,
         opa_policy_rule_to_eval: str,
     ):
+        if self.bundled:
+            self.register_bundled_policy(
+                local_rego_policy_file_path,
+                name,
+                rule_scope,
+                opa_policy_package_name,
+                opa_policy_rule_to_eval,
+            )
+            return
         rego_policy_asset = aws_s3_assets.Asset(
             self, f"{name}RegoAsset", path=str(local_rego_policy_file_path.resolve())
         )
         rego_policy_asset.grant_read(self.opa_lambda)
-        aws_config.CustomRule(
+        input_parameters = {
+            "ASSETS_BUCKET": rego_policy_asset.s3_bucket_name,
+            "REGO_POLICIES_PREFIX": "",
+            "REGO_POLICY_KEY": rego_policy_asset.s3_object_key,
+            "OPA_POLICY_PACKAGE_NAME": opa_policy_package_name,
+            "OPA_POLICY_RULE_TO_EVAL": opa_policy_rule_to_eval,
+        }
+        if self.opa_engine == "wasm":
+            wasm_bundle_asset = self.add_opa_wasm_bundle_asset(
+                local_rego_policy_file_path,
+                name,
+                "{}/{}".format(
+                    opa_policy_package_name.replace(".", "/"), opa_policy_rule_to_eval
+                ),
+            )
+            wasm_bundle_asset.grant_read(self.opa_lambda)
+            # Both assets are in the CDK assets bucket
+            input_parameters["OPA_WASM_BUNDLE_KEY"] = wasm_bundle_asset.s3_object_key
+        self.add_custom_rule(name, description, rule_scope, input_parameters)
+
+    def register_bundled_policy(
+        self,
+        local_rego_policy_file_path: Path,
+        name: str,
+        rule_scope: aws_config.RuleScope,
+        opa_policy_package_name: str,
+        opa_policy_rule_to_eval: str,
+    ):
+        if rule_scope is not None and (rule_scope.key or rule_scope.resource_id):
+            raise ValueError(
+                f"Policy {name} is scoped by tag or resource id, which bundled "
+                "mode can't route by"
+            )
+        resource_types = [POLICY_BUNDLE_ALL_RESOURCE_TYPES]
+        if rule_scope is not None and rule_scope.resource_types:
+            resource_types = [
+                resource_type.compliance_resource_type
+                for resource_type in rule_scope.resource_types
+            ]
+        self.bundled_policies[name] = {
+            "path": local_rego_policy_file_path.resolve(),
+            "package": opa_policy_package_name,
+            "rule": opa_policy_rule_to_eval,
+            "resource_types": resource_types,
+        }
+
+    def add_policy_bundle_rule(self, name: str, description: str):
+        """Create the Config rule evaluating every policy registered in bundled
+        mode, shipped as one bundle with an index from resource type to policy."""
+        bundle_dir = tempfile.mkdtemp(prefix="control-broker-policy-bundle-")
+        try:
+            os.makedirs(os.path.join(bundle_dir, POLICY_BUNDLE_POLICIES_DIR))
+            index = {"policies": {}, "resource_types": {}}
+            bundle_hash = hashlib.sha256()
+            for policy_name, policy in sorted(self.bundled_policies.items()):
+                policy_file = f"{POLICY_BUNDLE_POLICIES_DIR}/{policy_name}.rego"
+                shutil.copyfile(policy["path"], os.path.join(bundle_dir, policy_file))
+                bundle_hash.update(policy["path"].read_bytes())
+                index["policies"][policy_name] = {
+                    "package": policy["package"],
+                    "rule": policy["rule"],
+                    "file": policy_file,
+                }
+                for resource_type in policy["resource_types"]:
+                    index["resource_types"].setdefault(resource_type, []).append(
+                        policy_name
+                    )
+            bundle_hash.update(json.dumps(index, sort_keys=True).encode("utf-8"))
+            index["version"] = bundle_hash.hexdigest()
+            with open(
+                os.path.join(bundle_dir, POLICY_BUNDLE_INDEX_FILENAME),
+                "w",
+                encoding="utf-8",
+            ) as fp:
+                json.dump(index, fp, indent=2, sort_keys=True)
+            bundle_asset = aws_s3_assets.Asset(
+                self, f"{name}PolicyBundleAsset", path=bundle_dir
+            )
+        finally:
+            # The asset is staged into the cloud assembly when it's created
+            shutil.rmtree(bundle_dir, ignore_errors=True)
+        bundle_asset.grant_read(self.opa_lambda)
+        rule_scope = None
+        if POLICY_BUNDLE_ALL_RESOURCE_TYPES not in index["resource_types"]:
+            rule_scope = aws_config.RuleScope.from_resources(
+                [
+                    aws_config.ResourceType.of(resource_type)
+                    for resource_type in sorted(index["resource_types"])
+                ]
+            )
+        return self.add_custom_rule(
+            name,
+            description,
+            rule_scope,
+            {
+                "ASSETS_BUCKET": bundle_asset.s3_bucket_name,
+                "REGO_POLICIES_PREFIX": "",
+                "OPA_POLICY_BUNDLE_KEY": bundle_asset.s3_object_key,
+            },
+        )
+
+    def add_custom_rule(
+        self,
+        name: str,
+        description: str,
+        rule_scope: aws_config.RuleScope,
+        input_parameters: dict,
+    ):
+        if self.prime_on_init:
+            self.add_prime_policy(name, input_parameters)
+        return aws_config.CustomRule(
             self,
             name,
             description=description,
             config_rule_name=name,
-            lambda_function=self.opa_lambda,
+            lambda_function=self.rule_lambda,
             configuration_changes=True,
             periodic=True,
             rule_scope=rule_scope,
-            input_parameters={
-                "ASSETS_BUCKET": rego_policy_asset.s3_bucket_name,
-                "REGO_POLICIES_PREFIX": "",
-                "REGO_POLICY_KEY": rego_policy_asset.s3_object_key,
-                "OPA_POLICY_PACKAGE_NAME": opa_policy_package_name,
-                "OPA_POLICY_RULE_TO_EVAL": opa_policy_rule_to_eval,
-            },
+            input_parameters=input_parameters,
+        )
+
+    def add_prime_policy(self, name: str, input_parameters: dict):
+        prime_policies = self.prime_policies + [input_parameters]
+        if prime_policies_size(prime_policies) > PRIME_POLICIES_MAX_BYTES:
+            cdk.Annotations.of(self).add_warning(
+                f"The policy of rule {name} isn't primed, PRIME_POLICIES would "
+                f"exceed {PRIME_POLICIES_MAX_BYTES} bytes"
+            )
+            return
+        self.prime_policies = prime_policies
+        # Replaces the value set by the previous rule
+        self.opa_lambda.add_environment(
+            "PRIME_POLICIES", json.dumps(self.prime_policies, separators=(",", ":"))
+        )
+
+    def add_opa_wasm_bundle_asset(
+        self, local_rego_policy_file_path: Path, name: str, entrypoint: str
+    ) -> aws_s3_assets.Asset:
+        """Compile the policy to an OPA Wasm bundle with the given entrypoint."""
+        rego_policy_file_path = local_rego_policy_file_path.resolve()
+        # Hash the policy rather than its whole directory, so that changing
+        # one policy doesn't rebuild the bundles of the others
+        asset_hash = hashlib.sha256(
+            rego_policy_file_path.read_bytes()
+            + entrypoint.encode("utf-8")
+            + OPA_VERSION.encode("utf-8")
+        ).hexdigest()
+        return aws_s3_assets.Asset(
+            self,
+            f"{name}WasmBundleAsset",
+            path=str(rego_policy_file_path.parent),
+            asset_hash=asset_hash,
+            bundling=cdk.BundlingOptions(
+                image=cdk.DockerImage.from_registry(OPA_DOCKER_IMAGE),
+                command=opa_wasm_build_command(
+                    entrypoint,
+                    f"/asset-input/{rego_policy_file_path.name}",
+                    "/asset-output",
+                ),
+                output_type=cdk.BundlingOutput.ARCHIVED,
+                local=OpaWasmLocalBundling(rego_policy_file_path, entrypoint),
+            ),
         )
@@ -2,7 +2,6 @@ import logging
 import os
 from pathlib import Path
 
-import boto3
 import jsii
 from aws_cdk import (
     core as cdk,
@@ -18,6 +17,12 @@ from aws_cdk import (
 
 from mixins import PipelineMixin
 from control_broker import ControlBroker
+from synth_lookups import (
+    SynthLookups,
+    lookup_access_analyzer_statuses,
+    lookup_guardduty_detector_ids,
+    lookup_macie_status,
+)
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 SUPPLEMENTARY_FILES_DIR = os.path.join(CURRENT_DIR, "../supplementary_files")
@@ -51,6 +56,7 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
         local_guardduty_threat_intel_set_path: str = DEFAULT_GUARDDUTY_THREAT_INTEL_SCRIPT_PATH,
         local_conformance_pack_path: str = DEFAULT_CONFORMANCE_PACK_FILE_PATH,
         codestar_connection_arn_secret_id: str = None,
+        remediation_regions: list = None,
         **kwargs,
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -62,6 +68,17 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
         )
         self.local_conformance_pack_path = local_conformance_pack_path
         self.codestar_connection_arn_secret_id = codestar_connection_arn_secret_id
+        # Regions the reactive config rule stops non compliant instances in
+        self.remediation_regions = remediation_regions or [self.region]
+
+        # Start the synth time lookups of the stack at once, so they run
+        # concurrently while the stack is built
+        self.synth_lookups = SynthLookups(self)
+        self.synth_lookups.add("guardduty_detector_ids", lookup_guardduty_detector_ids)
+        self.synth_lookups.add("macie_status", lookup_macie_status)
+        self.synth_lookups.add(
+            "access_analyzer_statuses", lookup_access_analyzer_statuses
+        )
 
         self.configure_utility_s3_bucket()
         self.configure_pipeline(
@@ -124,6 +141,14 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
             runtime=aws_lambda.Runtime.PYTHON_3_7,
             code=aws_lambda.Code.asset(os.path.join(CONTROLS_SCRIPT_DIR, "lambdas")),
             handler="config_custom_rule_detective.handler",
+            # Periodic evaluations cover the whole fleet in one invocation
+            timeout=cdk.Duration.minutes(5),
+        )
+        self.config_detective_rule_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["ec2:DescribeInstances"],
+                resources=["*"],
+            )
         )
         # Create lambda for custom config rule (reactive).
         self.config_reactive_rule_lambda = aws_lambda.Function(
@@ -132,6 +157,19 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
             runtime=aws_lambda.Runtime.PYTHON_3_7,
             code=aws_lambda.Code.asset(os.path.join(CONTROLS_SCRIPT_DIR, "lambdas")),
             handler="config_custom_rule_reactive.handler",
+            # Remediating thousands of instances outlasts the default 3 seconds
+            timeout=cdk.Duration.minutes(5),
+            environment={"TARGET_REGIONS": ",".join(self.remediation_regions)},
+        )
+        self.config_reactive_rule_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=[
+                    "config:GetComplianceDetailsByConfigRule",
+                    "ec2:DescribeInstances",
+                    "ec2:StopInstances",
+                ],
+                resources=["*"],
+            )
         )
 
         # Create custom config rule (detective).
@@ -185,13 +223,8 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
         )
 
         # We cannot create multiple detectors in a single account/region
-        guardduty_client = boto3.client("guardduty")
-        if len(guardduty_client.list_detectors().get("DetectorIds", [None])) == 0:
-            existing_detector_id = None
-        else:
-            existing_detector_id = guardduty_client.list_detectors().get(
-                "DetectorIds", [None]
-            )[0]
+        detector_ids = self.synth_lookups.get("guardduty_detector_ids")
+        existing_detector_id = detector_ids[0] if detector_ids else None
         if existing_detector_id is None:
             # Create account-level GuardDuty detector.
             self.guardduty_detector = aws_guardduty.CfnDetector(
@@ -220,14 +253,7 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
         )
 
     def configure_macie(self):
-        macie_enabled = False
-
-        macie_client = boto3.client("macie2")
-        try:
-            macie_enabled = macie_client.get_macie_session().get("status") == "ENABLED"
-        except Exception as e:
-            if "Macie is not enabled" not in str(e):
-                raise
+        macie_enabled = self.synth_lookups.get("macie_status") == "ENABLED"
 
         if not macie_enabled:
             # Start Macie session
@@ -247,14 +273,9 @@ class ControlsPipelineStack(cdk.Stack, PipelineMixin):
         )
 
     def configure_iam_access_analyzer(self):
-        access_analyzer_client = boto3.client("accessanalyzer")
-        existing_analyzers = access_analyzer_client.list_analyzers().get(
-            "analyzers", [{}]
-        )
+        existing_analyzers = self.synth_lookups.get("access_analyzer_statuses")
         active_analyzers = [
-            analyzer
-            for analyzer in existing_analyzers
-            if analyzer.get("status") == "ACTIVE"
+            status for status in existing_analyzers if status == "ACTIVE"
         ]
         if active_analyzers:
             logger.info(
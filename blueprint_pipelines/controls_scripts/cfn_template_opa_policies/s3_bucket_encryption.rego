@@ -1,11 +1,19 @@
 package s3_bucket_encryption
 
+# input.ResourceIdsByType is added to each template by opa_eval.py, so only
+# the S3 buckets are visited instead of every resource in the template.
+# Templates evaluated without it, e.g. with opa eval, are scanned instead.
+bucket_ids = ids {
+    ids := input.ResourceIdsByType["AWS::S3::Bucket"]
+} else = ids {
+    not input.ResourceIdsByType
+    ids := {id | input.Resources[id].Type == "AWS::S3::Bucket"}
+}
+
 compliant {
-    some resource
-    input.Resources[resource].Type == "AWS::S3::Bucket"
-    input.Resources[resource].Properties.BucketEncryption.ServerSideEncryptionConfiguration[_].ServerSideEncryptionByDefault.SSEAlgorithm
+    bucket_id := bucket_ids[_]
+    input.Resources[bucket_id].Properties.BucketEncryption.ServerSideEncryptionConfiguration[_].ServerSideEncryptionByDefault.SSEAlgorithm
 } else = false {
     # Fail if buckets but not encrypted
-    some resource
-    input.Resources[resource].Type == "AWS::S3::Bucket"
-} else = true # Succeed if no buckets
\ No newline at end of file
+    count(bucket_ids) > 0
+} else = true # Succeed if no buckets
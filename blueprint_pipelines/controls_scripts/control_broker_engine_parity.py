@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import opa_eval
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.root.setLevel(logging.INFO)
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OPA_POLICIES_DIR = os.path.join(CURRENT_DIR, "config_event_opa_policies")
+CONTROL_BROKER_LAMBDA_PATH = os.path.join(
+    CURRENT_DIR, "lambdas/control_broker_opa_lambda/control-broker-opa-lambda.py"
+)
+WASM_BUNDLE_FILENAME = "bundle.tar.gz"
+# Configuration items covering the compliant and non compliant cases of every
+# config event policy, plus resource types no policy applies to.
+SAMPLE_CONFIGURATION_ITEMS = [
+    {"resourceType": "AWS::EC2::Volume", "configuration": {"attachments": []}},
+    {
+        "resourceType": "AWS::EC2::Volume",
+        "configuration": {"attachments": [{"instanceId": "i-1"}], "encrypted": True},
+    },
+    {"resourceType": "AWS::EC2::Volume", "configuration": {"encrypted": False}},
+    {"resourceType": "AWS::EC2::EIP", "configuration": {"associationId": None}},
+    {"resourceType": "AWS::EC2::EIP", "configuration": {"associationId": "eipassoc-1"}},
+    {"resourceType": "AWS::S3::Bucket", "supplementaryConfiguration": {}},
+    {"resourceType": "AWS::SNS::Topic", "configuration": {}},
+] + [
+    {
+        "resourceType": "AWS::S3::Bucket",
+        "supplementaryConfiguration": {
+            "ServerSideEncryptionConfiguration": {
+                "rules": [
+                    {"applyServerSideEncryptionByDefault": {"sseAlgorithm": algorithm}}
+                ]
+            }
+        },
+    }
+    for algorithm in ("AES256", "aws:kms", "none")
+]
+
+
+def load_control_broker_lambda():
+    spec = importlib.util.spec_from_file_location(
+        "control_broker_opa_lambda", CONTROL_BROKER_LAMBDA_PATH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_policy_package(policy_file):
+    module = opa_eval.run_process(
+        opa_eval.OPA_PARSE_COMMAND_TEMPLATE.format(
+            opa_binary_path=opa_eval.OPA_BINARY_PATH, policy_file_path=policy_file
+        )
+    )
+    # The first term of a package path is always `data`
+    return [term["value"] for term in module["package"]["path"][1:]]
+
+
+def build_wasm_bundle(policy_file, entrypoint, output_dir):
+    bundle_path = os.path.join(output_dir, WASM_BUNDLE_FILENAME)
+    subprocess.run(
+        [
+            opa_eval.OPA_BINARY_PATH,
+            "build",
+            "-t",
+            "wasm",
+            "-e",
+            entrypoint,
+            "-o",
+            bundle_path,
+            policy_file,
+        ],
+        check=True,
+    )
+    return bundle_path
+
+
+def check_policy_parity(control_broker, policy_file, rule, configuration_items):
+    """Return the configuration items the two engines disagree on."""
+    package = get_policy_package(policy_file)
+    entrypoint = "/".join(package + [rule])
+    work_dir = tempfile.mkdtemp(prefix="control-broker-engine-parity-")
+    try:
+        wasm_policy = control_broker.WasmPolicy(
+            build_wasm_bundle(policy_file, entrypoint, work_dir), entrypoint
+        )
+        mismatches = []
+        for configuration_item in configuration_items:
+            input_file = control_broker.get_tempfile(json.dumps(configuration_item))
+            try:
+                opa = control_broker.Opa(input_file.name, ".".join(package), rule)
+                subprocess_result = opa.eval_compliance(policy_file)
+            finally:
+                input_file.close()
+            wasm_result = wasm_policy.eval_compliance(configuration_item)
+            if subprocess_result != wasm_result:
+                logger.error(
+                    "%s: subprocess returned %s and wasm returned %s for %s",
+                    entrypoint,
+                    subprocess_result,
+                    wasm_result,
+                    json.dumps(configuration_item),
+                )
+                mismatches.append(configuration_item)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logger.info(
+        "%s: %s of %s configuration items match",
+        entrypoint,
+        len(configuration_items) - len(mismatches),
+        len(configuration_items),
+    )
+    return mismatches
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check that the Control Broker subprocess and Wasm engines agree."
+    )
+    parser.add_argument(
+        "--opa-files-dir",
+        default=DEFAULT_OPA_POLICIES_DIR,
+        help="Directory containing the rego policies",
+    )
+    parser.add_argument(
+        "--rule",
+        default=opa_eval.COMPLIANCE_RULE_NAME,
+        help="Rule of each policy to evaluate",
+    )
+    parser.add_argument(
+        "--configuration-items",
+        help="JSON file with a list of configuration items to use instead of the samples",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configuration_items = SAMPLE_CONFIGURATION_ITEMS
+    if args.configuration_items:
+        with open(args.configuration_items, encoding="utf-8") as fp:
+            configuration_items = json.load(fp)
+    # The subprocess engine runs `opa` from the PATH, like in the Lambda layer
+    os.environ["PATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(opa_eval.OPA_BINARY_PATH)), os.environ["PATH"]]
+    )
+    control_broker = load_control_broker_lambda()
+    control_broker.logger.setLevel(logging.WARNING)
+    mismatched_policies = [
+        policy_file
+        for policy_file in opa_eval.iter_policy_files(args.opa_files_dir, (".rego",))
+        if check_policy_parity(
+            control_broker, policy_file, args.rule, configuration_items
+        )
+    ]
+    if mismatched_policies:
+        logger.error(
+            "The engines disagree on %s policies: %s",
+            len(mismatched_policies),
+            ", ".join(mismatched_policies),
+        )
+        sys.exit(1)
+    logger.info("The engines agree on every policy")
+
+
+if __name__ == "__main__":
+    main()
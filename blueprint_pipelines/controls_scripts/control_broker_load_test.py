@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import datetime
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+
+import opa_eval
+from control_broker_engine_parity import (
+    build_wasm_bundle,
+    get_policy_package,
+    load_control_broker_lambda,
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.root.setLevel(logging.INFO)
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OPA_POLICIES_DIR = os.path.join(CURRENT_DIR, "config_event_opa_policies")
+DEFAULT_OUTPUT_FILE = "control_broker_load_test.json"
+ENGINES = ("subprocess", "server", "wasm")
+# The dynamodb verdict cache needs VERDICT_CACHE_TABLE and, to stay local,
+# VERDICT_CACHE_ENDPOINT_URL in the environment
+VERDICT_CACHES = ("memory", "none", "dynamodb")
+ASSETS_BUCKET = "control-broker-load-test"
+# Resource type of the configuration items generated for each policy package
+POLICY_RESOURCE_TYPES = {
+    "s3_bucket_encryption": "AWS::S3::Bucket",
+    "ebs_attachment": "AWS::EC2::Volume",
+    "ebs_encryption": "AWS::EC2::Volume",
+    "eip_attachment": "AWS::EC2::EIP",
+}
+RESOURCE_ID_PREFIXES = {
+    "AWS::S3::Bucket": "load-test-bucket-",
+    "AWS::EC2::Volume": "vol-",
+    "AWS::EC2::EIP": "eipalloc-",
+}
+FIRST_CAPTURE_TIME = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class LocalS3:
+    """Stand-in for the S3 client of the Lambda, serving the files of a local
+    directory by key."""
+
+    def __init__(self, objects_dir, latency):
+        self.objects_dir = objects_dir
+        self.latency = latency
+        self.calls = 0
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        with open(os.path.join(self.objects_dir, Key), "rb") as fp:
+            body = fp.read()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if IfNoneMatch == etag:
+            raise ClientError(
+                {
+                    "Error": {"Code": "304", "Message": "Not Modified"},
+                    "ResponseMetadata": {"HTTPStatusCode": 304},
+                },
+                "GetObject",
+            )
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+
+class LocalConfig:
+    """Stand-in for the Config client of the Lambda, counting the evaluations
+    it is sent by compliance type."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.evaluations = collections.Counter()
+
+    def put_evaluations(self, Evaluations, ResultToken, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        for evaluation in Evaluations:
+            self.evaluations[evaluation["ComplianceType"]] += 1
+        return {"FailedEvaluations": []}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def prepare_policies(opa_files_dir, rule, objects_dir, build_wasm):
+    """Put the policies, and their Wasm bundles if needed, in the local S3
+    directory and return their rule parameters by package."""
+    policies = {}
+    for policy_file in opa_eval.iter_policy_files(opa_files_dir, (".rego",)):
+        package = ".".join(get_policy_package(policy_file))
+        policy_dir = os.path.join(objects_dir, package)
+        os.makedirs(policy_dir)
+        shutil.copyfile(policy_file, os.path.join(policy_dir, "policy.rego"))
+        rule_parameters = {
+            "ASSETS_BUCKET": ASSETS_BUCKET,
+            "REGO_POLICIES_PREFIX": "",
+            "REGO_POLICY_KEY": "{}/policy.rego".format(package),
+            "OPA_POLICY_PACKAGE_NAME": package,
+            "OPA_POLICY_RULE_TO_EVAL": rule,
+        }
+        if build_wasm:
+            bundle_path = build_wasm_bundle(
+                policy_file, "{}/{}".format(package.replace(".", "/"), rule), policy_dir
+            )
+            rule_parameters["OPA_WASM_BUNDLE_KEY"] = os.path.relpath(
+                bundle_path, objects_dir
+            )
+        policies[package] = rule_parameters
+    return policies
+
+
+def generate_configuration_item(resource_type, resource_id, seed):
+    """Return the configuration item of a resource, the same for every event
+    of the resource so that repeated events can hit the verdict cache."""
+    rng = random.Random("{}/{}".format(seed, resource_id))
+    item = {
+        "resourceId": resource_id,
+        "resourceType": resource_type,
+        "configurationItemStatus": "OK",
+        "configuration": {},
+        "supplementaryConfiguration": {},
+        "relationships": [],
+    }
+    if resource_type == "AWS::S3::Bucket":
+        algorithm = rng.choice(["AES256", "aws:kms", None])
+        if algorithm:
+            item["supplementaryConfiguration"]["ServerSideEncryptionConfiguration"] = {
+                "rules": [
+                    {"applyServerSideEncryptionByDefault": {"sseAlgorithm": algorithm}}
+                ]
+            }
+    elif resource_type == "AWS::EC2::Volume":
+        item["configuration"] = {
+            "encrypted": rng.random() < 0.5,
+            "attachments": (
+                [{"instanceId": "i-{:017x}".format(rng.getrandbits(68))}]
+                if rng.random() < 0.5
+                else []
+            ),
+        }
+    elif resource_type == "AWS::EC2::EIP":
+        item["configuration"] = {
+            "associationId": (
+                "eipassoc-{:017x}".format(rng.getrandbits(68))
+                if rng.random() < 0.5
+                else None
+            )
+        }
+    return item
+
+
+def config_event(rule_name, rule_parameters, configuration_item, result_token):
+    return {
+        "configRuleName": rule_name,
+        "invokingEvent": json.dumps(
+            {
+                "configurationItem": configuration_item,
+                "messageType": "ConfigurationItemChangeNotification",
+                "notificationCreationTime": configuration_item[
+                    "configurationItemCaptureTime"
+                ],
+            }
+        ),
+        "ruleParameters": json.dumps(rule_parameters),
+        "resultToken": result_token,
+        "eventLeftScope": False,
+    }
+
+
+def generate_events(policies, invocations, resources, seed):
+    """Generate change notifications for the policies in turn, each for one of
+    `resources` resources of the policy's resource type."""
+    packages = [
+        package for package in sorted(policies) if package in POLICY_RESOURCE_TYPES
+    ]
+    if not packages:
+        raise ValueError("None of the policies has a known resource type")
+    rng = random.Random(seed)
+    events = []
+    for i in range(invocations):
+        package = packages[i % len(packages)]
+        resource_type = POLICY_RESOURCE_TYPES[package]
+        resource_id = "{}{:08x}".format(
+            RESOURCE_ID_PREFIXES[resource_type], rng.randrange(resources)
+        )
+        configuration_item = generate_configuration_item(
+            resource_type, resource_id, seed
+        )
+        configuration_item["configurationItemCaptureTime"] = (
+            FIRST_CAPTURE_TIME + datetime.timedelta(seconds=i)
+        ).isoformat()
+        events.append(
+            config_event(
+                package, policies[package], configuration_item, "load-test-{}".format(i)
+            )
+        )
+    return events
+
+
+def point_events_at_policies(events, policies):
+    """Point the rule parameters of Config events at the local copy of the
+    policy package they evaluate, and return the events."""
+    for event in events:
+        package = json.loads(event["ruleParameters"])["OPA_POLICY_PACKAGE_NAME"]
+        if package not in policies:
+            raise ValueError(
+                "Event of rule {} evaluates unknown package {}".format(
+                    event["configRuleName"], package
+                )
+            )
+        event["ruleParameters"] = json.dumps(policies[package])
+    return events
+
+
+def load_replay_events(events_file, policies):
+    """Return recorded Config events with their rule parameters pointing at the
+    local copy of the policy package they evaluate."""
+    with open(events_file, encoding="utf-8") as fp:
+        return point_events_at_policies(json.load(fp), policies)
+
+
+def run_configuration(spec):
+    """Run the events through lambda_handler in this process, as one warm
+    execution environment, and return the latencies."""
+    with open(spec["events_file"], encoding="utf-8") as fp:
+        events = json.load(fp)
+    started_at = time.perf_counter()
+    control_broker = load_control_broker_lambda()
+    init_seconds = time.perf_counter() - started_at
+    s3 = LocalS3(spec["objects_dir"], spec["service_latency"])
+    config = LocalConfig(spec["service_latency"])
+    control_broker.clients[("s3", None)] = s3
+    control_broker.clients[("config", None)] = config
+    latencies = []
+    errors = 0
+    try:
+        started_at = time.perf_counter()
+        for i, event in enumerate(events):
+            if spec["rate"]:
+                # Invocations are scheduled at the target rate and run late,
+                # never concurrently, when the handler can't keep up
+                time.sleep(max(0, started_at + i / spec["rate"] - time.perf_counter()))
+            invoked_at = time.perf_counter()
+            try:
+                control_broker.lambda_handler(event, None)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - invoked_at)
+        wall_seconds = time.perf_counter() - started_at
+    finally:
+        # Wait for the OPA server so its memory counts towards the peak RSS
+        server_process = control_broker.opa_server.process
+        if server_process and server_process.poll() is None:
+            server_process.terminate()
+            server_process.wait()
+    return {
+        "init_seconds": init_seconds,
+        "first_invocation_seconds": latencies[0],
+        "latencies": latencies,
+        "wall_seconds": wall_seconds,
+        "errors": errors,
+        "s3_calls": s3.calls,
+        "config_calls": config.calls,
+        "evaluations": dict(config.evaluations),
+        "verdict_cache_stats": dict(control_broker.verdict_cache_stats),
+    }
+
+
+def benchmark_configuration(engine, verdict_cache, spec, warmup):
+    """Run one engine and verdict cache configuration in a new process and
+    summarize its latencies, throughput and peak RSS."""
+    work_dir = tempfile.mkdtemp(prefix="control-broker-load-test-run-")
+    try:
+        spec_file = os.path.join(work_dir, "spec.json")
+        result_file = os.path.join(work_dir, "result.json")
+        with open(spec_file, "w", encoding="utf-8") as fp:
+            json.dump(dict(spec, result_file=result_file), fp)
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--run-configuration",
+                spec_file,
+            ],
+            env=dict(
+                os.environ,
+                OPA_ENGINE=engine,
+                VERDICT_CACHE_BACKEND=verdict_cache,
+                PRIME_ON_INIT="false",
+            ),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        # The peak RSS is the largest of the Lambda's process and of the OPA
+        # processes it waited on, in KiB
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = (
+            os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        )
+        if process.returncode != 0:
+            raise RuntimeError(
+                "{}/{}: the run exited with code {}".format(
+                    engine, verdict_cache, process.returncode
+                )
+            )
+        with open(result_file, encoding="utf-8") as fp:
+            run = json.load(fp)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    invocations = len(run["latencies"])
+    latencies = run.pop("latencies")[warmup:] or [0.0]
+    result = {
+        "configuration": "{}/{}".format(engine, verdict_cache),
+        "engine": engine,
+        "verdict_cache": verdict_cache,
+        "p50_seconds": percentile(latencies, 0.5),
+        "p95_seconds": percentile(latencies, 0.95),
+        "p99_seconds": percentile(latencies, 0.99),
+        "max_seconds": max(latencies),
+        "invocations_per_second": invocations / run["wall_seconds"],
+        "peak_rss_kib": rusage.ru_maxrss,
+    }
+    result.update(run)
+    logger.info(
+        "%s: p50 %.1fms, p95 %.1fms, p99 %.1fms, %.1f invocations/s, peak RSS %s KiB",
+        result["configuration"],
+        result["p50_seconds"] * 1000,
+        result["p95_seconds"] * 1000,
+        result["p99_seconds"] * 1000,
+        result["invocations_per_second"],
+        result["peak_rss_kib"],
+    )
+    if result["errors"]:
+        logger.error(
+            "%s: %s invocations failed", result["configuration"], result["errors"]
+        )
+    return result
+
+
+def find_regressions(results, baseline_file, max_regression):
+    """Return the configurations whose p95 latency regressed past max_regression."""
+    with open(baseline_file, encoding="utf-8") as fp:
+        baseline = {
+            result["configuration"]: result for result in json.load(fp)["results"]
+        }
+    regressions = []
+    for result in results:
+        if result["configuration"] not in baseline:
+            continue
+        baseline_seconds = baseline[result["configuration"]]["p95_seconds"]
+        change = result["p95_seconds"] / baseline_seconds - 1
+        if change > max_regression:
+            logger.error(
+                "%s: p95 latency regressed by %.0f%% (%.1fms -> %.1fms)",
+                result["configuration"],
+                change * 100,
+                baseline_seconds * 1000,
+                result["p95_seconds"] * 1000,
+            )
+            regressions.append(result["configuration"])
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test the Control Broker Lambda handler with local "
+        "stand-ins for S3 and Config."
+    )
+    parser.add_argument(
+        "--opa-files-dir",
+        default=DEFAULT_OPA_POLICIES_DIR,
+        help="Directory containing the rego policies",
+    )
+    parser.add_argument(
+        "--rule",
+        default=opa_eval.COMPLIANCE_RULE_NAME,
+        help="Rule of each policy to evaluate",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=ENGINES,
+        default=list(ENGINES),
+        help="OPA engines to load test",
+    )
+    parser.add_argument(
+        "--verdict-caches",
+        nargs="+",
+        choices=VERDICT_CACHES,
+        default=["memory", "none"],
+        help="Verdict cache backends to load test",
+    )
+    parser.add_argument(
+        "--events",
+        help="JSON file with a list of recorded Config events to replay instead "
+        "of generating them",
+    )
+    parser.add_argument(
+        "--invocations", type=int, default=1000, help="Number of events to generate"
+    )
+    parser.add_argument(
+        "--resources",
+        type=int,
+        default=100,
+        help="Number of distinct resources of each type in the generated events",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the generated events"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Target invocations per second, or 0 to invoke back to back",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Number of first invocations left out of the latency percentiles",
+    )
+    parser.add_argument(
+        "--service-latency",
+        type=float,
+        default=0,
+        help="Seconds added to every call to the S3 and Config stand-ins",
+    )
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT_FILE,
+        help="File to write the load test results to as JSON",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Results file of a previous load test to compare p95 latencies with",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="Fraction by which a p95 latency may exceed the baseline before failing",
+    )
+    parser.add_argument("--run-configuration", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run_configuration:
+        with open(args.run_configuration, encoding="utf-8") as fp:
+            spec = json.load(fp)
+        result = run_configuration(spec)
+        with open(spec["result_file"], "w", encoding="utf-8") as fp:
+            json.dump(result, fp)
+        return
+    # The Lambda runs `opa` from the PATH, like in the Lambda layer
+    os.environ["PATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(opa_eval.OPA_BINARY_PATH)), os.environ["PATH"]]
+    )
+    work_dir = tempfile.mkdtemp(prefix="control-broker-load-test-")
+    try:
+        objects_dir = os.path.join(work_dir, "objects")
+        policies = prepare_policies(
+            args.opa_files_dir, args.rule, objects_dir, "wasm" in args.engines
+        )
+        if args.events:
+            events = load_replay_events(args.events, policies)
+        else:
+            events = generate_events(
+                policies, args.invocations, args.resources, args.seed
+            )
+        events_file = os.path.join(work_dir, "events.json")
+        with open(events_file, "w", encoding="utf-8") as fp:
+            json.dump(events, fp)
+        logger.info("Running %s events per configuration", len(events))
+        spec = {
+            "events_file": events_file,
+            "objects_dir": objects_dir,
+            "rate": args.rate,
+            "service_latency": args.service_latency,
+        }
+        results = [
+            benchmark_configuration(engine, verdict_cache, spec, args.warmup)
+            for engine in args.engines
+            for verdict_cache in args.verdict_caches
+        ]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.output, "w", encoding="utf-8") as fp:
+        json.dump(
+            {
+                "parameters": {
+                    "events": args.events,
+                    "invocations": len(events),
+                    "resources": args.resources,
+                    "seed": args.seed,
+                    "rate": args.rate,
+                    "warmup": args.warmup,
+                    "service_latency": args.service_latency,
+                    "opa_binary_path": opa_eval.OPA_BINARY_PATH,
+                },
+                "results": results,
+            },
+            fp,
+            indent=2,
+        )
+    logger.info("Wrote load test results to %s", args.output)
+    if args.baseline and find_regressions(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import opa_eval
+from control_broker_engine_parity import load_control_broker_lambda
+from control_broker_load_test import (
+    DEFAULT_OPA_POLICIES_DIR,
+    LocalConfig,
+    LocalS3,
+    point_events_at_policies,
+    prepare_policies,
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.root.setLevel(logging.INFO)
+
+
+class LocalQueue:
+    """In-memory stand-in for the SQS queue of the Control Broker, with the
+    send_message method of the SQS client that enqueue_handler uses."""
+
+    def __init__(self, max_receive_count):
+        self.max_receive_count = max_receive_count
+        self.messages = []
+        self.dead_letters = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        message_id = str(uuid.uuid4())
+        self.messages.append(
+            {"messageId": message_id, "body": MessageBody, "receiveCount": 0}
+        )
+        return {"MessageId": message_id}
+
+    def receive(self, batch_size):
+        batch = self.messages[:batch_size]
+        del self.messages[:batch_size]
+        for message in batch:
+            message["receiveCount"] += 1
+        return batch
+
+    def fail(self, message):
+        """Make a failed message visible again, or dead letter it after
+        max_receive_count receives like the queue's redrive policy."""
+        if message["receiveCount"] >= self.max_receive_count:
+            self.dead_letters.append(message)
+        else:
+            self.messages.append(message)
+
+
+def load_events(event_files):
+    """Return the Config events in the files, which hold one event or a list."""
+    events = []
+    for event_file in event_files:
+        with open(event_file, encoding="utf-8") as fp:
+            content = json.load(fp)
+        events.extend(content if isinstance(content, list) else [content])
+    return events
+
+
+def run_queue(control_broker, queue, batch_size):
+    """Feed the queue to queue_handler in batches until it is empty."""
+    batches = 0
+    while queue.messages:
+        batch = queue.receive(batch_size)
+        response = control_broker.queue_handler(
+            {
+                "Records": [
+                    {
+                        "messageId": message["messageId"],
+                        "body": message["body"],
+                        "attributes": {
+                            "ApproximateReceiveCount": str(message["receiveCount"])
+                        },
+                    }
+                    for message in batch
+                ]
+            },
+            None,
+        )
+        failed_message_ids = {
+            failure["itemIdentifier"] for failure in response["batchItemFailures"]
+        }
+        for message in batch:
+            if message["messageId"] in failed_message_ids:
+                queue.fail(message)
+        batches += 1
+        logger.info(
+            "Batch %s: %s messages, %s failed",
+            batches,
+            len(batch),
+            len(failed_message_ids),
+        )
+    return batches
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run Config events through the Control Broker queue "
+        "topology with an in-memory queue and local stand-ins for S3 and Config."
+    )
+    parser.add_argument(
+        "event_files", nargs="+", help="JSON files with a Config event or a list"
+    )
+    parser.add_argument(
+        "--opa-files-dir",
+        default=DEFAULT_OPA_POLICIES_DIR,
+        help="Directory containing the rego policies the events evaluate",
+    )
+    parser.add_argument(
+        "--rule",
+        default=opa_eval.COMPLIANCE_RULE_NAME,
+        help="Rule of each policy to evaluate",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10, help="Messages per queue_handler batch"
+    )
+    parser.add_argument(
+        "--max-receive-count",
+        type=int,
+        help="Receives before a failed message is dead lettered, the "
+        "QUEUE_MAX_RECEIVE_COUNT of the Lambda by default",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.max_receive_count:
+        os.environ["QUEUE_MAX_RECEIVE_COUNT"] = str(args.max_receive_count)
+    # The Lambda runs `opa` from the PATH, like in the Lambda layer
+    os.environ["PATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(opa_eval.OPA_BINARY_PATH)), os.environ["PATH"]]
+    )
+    control_broker = load_control_broker_lambda()
+    queue = LocalQueue(control_broker.QUEUE_MAX_RECEIVE_COUNT)
+    config = LocalConfig(0)
+    work_dir = tempfile.mkdtemp(prefix="control-broker-local-queue-")
+    try:
+        objects_dir = os.path.join(work_dir, "objects")
+        policies = prepare_policies(
+            args.opa_files_dir,
+            args.rule,
+            objects_dir,
+            control_broker.OPA_ENGINE == "wasm",
+        )
+        events = point_events_at_policies(load_events(args.event_files), policies)
+        # The handlers call SQS, S3 and Config through the cached clients
+        control_broker.clients[("sqs", None)] = queue
+        control_broker.clients[("s3", None)] = LocalS3(objects_dir, 0)
+        control_broker.clients[("config", None)] = config
+        for event in events:
+            control_broker.enqueue_handler(event, None)
+        batches = run_queue(control_broker, queue, args.batch_size)
+    finally:
+        server_process = control_broker.opa_server.process
+        if server_process and server_process.poll() is None:
+            server_process.terminate()
+            server_process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logger.info(
+        "Processed %s events in %s batches, %s dead lettered, evaluations: %s",
+        len(events),
+        batches,
+        len(queue.dead_letters),
+        dict(config.evaluations),
+    )
+    if queue.dead_letters:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
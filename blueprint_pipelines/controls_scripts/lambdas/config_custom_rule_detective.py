@@ -1,19 +1,44 @@
 # Import packages.
 import json
+import logging
+import random
+import time
 import boto3
- 
- # Initalize parameters.
-config = boto3.client("config")
-compliance_value = "NOT_APPLICABLE"
+from botocore.config import Config
+
+# Initalize parameters.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Throttled calls are retried by botocore, backing off between attempts.
+client_config = Config(retries={"max_attempts": 10, "mode": "standard"})
+config = boto3.client("config", config=client_config)
+ec2 = boto3.client("ec2", config=client_config)
+# The most instances describe_instances returns per page.
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+# The most evaluations put_evaluations accepts per call.
+PUT_EVALUATIONS_MAX_BATCH_SIZE = 100
+# Evaluations Config fails to record are sent again, with exponential back-off and jitter, up to this many times.
+PUT_EVALUATIONS_MAX_ATTEMPTS = 5
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 10
+# States of the instances a periodic evaluation covers, all but terminated.
+EVALUATED_INSTANCE_STATES = ["pending", "running", "shutting-down", "stopping", "stopped"]
 
 def handler(event, context):
-    
+
     # Parse the event argument for invokingEvent, ruleParameters, configurationItem, and configurationItemStatus.
     invoking_event = json.loads(event["invokingEvent"])
     rule_parameters = json.loads(event["ruleParameters"])
+
+    # On the periodic trigger, evaluate every instance in scope at once.
+    if invoking_event["messageType"] == "ScheduledNotification":
+        evaluate_fleet(event, invoking_event)
+        return
+
     item = invoking_event["configurationItem"]
     item_status = item["configurationItemStatus"]
-    
+    compliance_value = "NOT_APPLICABLE"
+
     # Check if the event is eligible to be evaluated, and if so evaluate it.
     if eligible_event(item_status, event):
         compliance_value = evaluate_compliance(item, rule_parameters)
@@ -40,12 +65,75 @@ def eligible_event(item_status, event):
 
 # Evaluate based on the rule and return the compliance.
 def evaluate_compliance(config_item, rule_parameters):
-    if config_item["resourceType"] is "AWS::EC2::Instance":
-        if len(config_item["configuration"]["tags"]) <= 1:
-            return "NON_COMPLIANT"
-        elif len(config_item["configuration"]["tags"]) > 1:
-            return "COMPLIANT"
-        else:    
-            return "NOT_APPLICABLE"
+    if config_item["resourceType"] == "AWS::EC2::Instance":
+        return evaluate_tags(config_item["configuration"]["tags"])
     else:
-        return "COMPLIANT"
\ No newline at end of file
+        return "COMPLIANT"
+
+# Instances need at least two tags to be compliant.
+def evaluate_tags(tags):
+    if len(tags) <= 1:
+        return "NON_COMPLIANT"
+    else:
+        return "COMPLIANT"
+
+# Evaluate every instance in the rule's scope from a tag index built with a few paginated calls, and send the
+# evaluations in batches instead of one invocation per instance.
+def evaluate_fleet(event, invoking_event):
+    tag_index = build_tag_index(get_scope_filters(event["configRuleName"]))
+    evaluations = [
+        {
+            "ComplianceResourceType": "AWS::EC2::Instance",
+            "ComplianceResourceId": instance_id,
+            "ComplianceType": evaluate_tags(tags),
+            "OrderingTimestamp": invoking_event["notificationCreationTime"]
+        }
+        for instance_id, tags in sorted(tag_index.items())
+    ]
+    failed_evaluations = []
+    for start in range(0, len(evaluations), PUT_EVALUATIONS_MAX_BATCH_SIZE):
+        batch = evaluations[start:start + PUT_EVALUATIONS_MAX_BATCH_SIZE]
+        failed_evaluations.extend(put_evaluations(batch, event["resultToken"]))
+    if failed_evaluations:
+        logger.error("Config failed to record %s evaluations: %s", len(failed_evaluations), failed_evaluations)
+    logger.info(
+        "Evaluated %s instances, %s non compliant",
+        len(evaluations),
+        sum(1 for evaluation in evaluations if evaluation["ComplianceType"] == "NON_COMPLIANT"))
+
+# Send a batch of evaluations, sending those Config returns as failed again with back-off, and return the
+# evaluations that still failed after the last attempt.
+def put_evaluations(batch, result_token):
+    for attempt in range(PUT_EVALUATIONS_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt)))
+        batch = config.put_evaluations(Evaluations=batch, ResultToken=result_token).get("FailedEvaluations", [])
+        if not batch:
+            return []
+    return batch
+
+# Return the describe_instances filters matching the tag scope of the rule, if it has one.
+def get_scope_filters(config_rule_name):
+    rule = config.describe_config_rules(ConfigRuleNames=[config_rule_name])["ConfigRules"][0]
+    scope = rule.get("Scope", {})
+    if "TagKey" not in scope:
+        return []
+    if "TagValue" in scope:
+        return [{"Name": "tag:" + scope["TagKey"], "Values": [scope["TagValue"]]}]
+    return [{"Name": "tag-key", "Values": [scope["TagKey"]]}]
+
+# Page through the instances matching the filters and return their tags by instance ID.
+def build_tag_index(filters):
+    tag_index = {}
+    kwargs = {
+        "Filters": filters + [{"Name": "instance-state-name", "Values": EVALUATED_INSTANCE_STATES}],
+        "MaxResults": DESCRIBE_INSTANCES_PAGE_SIZE,
+    }
+    while True:
+        response = ec2.describe_instances(**kwargs)
+        for reservation in response["Reservations"]:
+            for instance in reservation["Instances"]:
+                tag_index[instance["InstanceId"]] = instance.get("Tags", [])
+        if not response.get("NextToken"):
+            return tag_index
+        kwargs["NextToken"] = response["NextToken"]
@@ -1,22 +1,147 @@
 # Import packages.
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Initialize Paraneters
-ec2 = boto3.client("ec2", region_name="us-east-2")
-config_client = boto3.client("config")
-instanceIds = []
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Regions to remediate, each with the detective rule deployed, defaulting to the Lambda's own region.
+TARGET_REGIONS = os.environ.get("TARGET_REGIONS", os.environ.get("AWS_REGION", "us-east-2")).split(",")
+# Regions are remediated concurrently, by at most this many threads.
+MAX_CONCURRENT_REGIONS = int(os.environ.get("MAX_CONCURRENT_REGIONS", "8"))
+# Clients are created once per region and reused, with their connection pools, by every invocation.
+# boto3 clients are thread safe, but creating them isn't, so they are all created here.
+client_config = Config(max_pool_connections=10)
+regional_clients = {
+    region: {
+        "config": boto3.client("config", region_name=region, config=client_config),
+        "ec2": boto3.client("ec2", region_name=region, config=client_config),
+    }
+    for region in TARGET_REGIONS
+}
+DETECTIVE_RULE_NAME = "DetectEc2TagViolation"
+# The most results get_compliance_details_by_config_rule returns per page.
+COMPLIANCE_DETAILS_PAGE_SIZE = 100
+# Instance IDs per describe_instances filter and per stop_instances call.
+EC2_BATCH_SIZE = 200
+# Throttled calls are retried with exponential back-off and jitter.
+THROTTLING_ERROR_CODES = ("RequestLimitExceeded", "Throttling", "ThrottlingException")
+MAX_ATTEMPTS = 8
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 20
+
 
 def handler(event, context):
-    # Get the details of the resources that are not compliant with our detective custom config rule (DetectEc2TagViolation).
-    details = config_client.get_compliance_details_by_config_rule(
-        ConfigRuleName = "DetectEc2TagViolation", 
-        ComplianceTypes = ["NON_COMPLIANT"]
-    )
-    # If there are non_compliant instances for our detective custom rule, stop the non_compliant instances.
-    if len(details["EvaluationResults"]) != 0:
-        # Compile a list of instance IDs of non_compliant instances.
+    # Remediate every target region at the same time, so the slowest region sets the remediation time.
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REGIONS, len(TARGET_REGIONS))) as executor:
+        region_summaries = dict(zip(TARGET_REGIONS, executor.map(remediate_region, TARGET_REGIONS)))
+    summary = {
+        "stopped": sum(len(region_summary["stopped"]) for region_summary in region_summaries.values()),
+        "skipped": sum(region_summary["skipped"] for region_summary in region_summaries.values()),
+        "failed": sum(len(region_summary["failed"]) for region_summary in region_summaries.values()),
+        "failed_regions": sorted(region for region, region_summary in region_summaries.items() if "error" in region_summary),
+        "regions": region_summaries,
+    }
+    logger.info("Remediation summary: %s", summary)
+    return summary
+
+
+# Stop the non compliant instances of one region and return what was stopped, skipped or failed there.
+def remediate_region(region):
+    clients = regional_clients[region]
+    try:
+        # Get the IDs of every instance that is not compliant with our detective custom config rule (DetectEc2TagViolation).
+        instance_ids = get_non_compliant_instance_ids(clients["config"])
+        # Only running instances need stopping, the others are already stopping, stopped or gone.
+        running_instance_ids = get_running_instance_ids(clients["ec2"], instance_ids)
+        stopped_instance_ids, failed_instance_ids = stop_instances(clients["ec2"], running_instance_ids)
+    except (ClientError, BotoCoreError) as e:
+        # A region failing, e.g. without the detective rule or with its endpoint unreachable, doesn't stop the others.
+        return {"non_compliant": 0, "stopped": [], "skipped": 0, "failed": [], "error": str(e)}
+    return {
+        "non_compliant": len(instance_ids),
+        "stopped": stopped_instance_ids,
+        "skipped": len(instance_ids) - len(running_instance_ids),
+        "failed": failed_instance_ids,
+    }
+
+
+# Call an AWS API, retrying with back-off while it is throttled.
+def call_with_backoff(function, **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return function(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLING_ERROR_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt)))
+
+
+# Page through every NON_COMPLIANT evaluation of the detective rule and return the instance IDs, without duplicates.
+def get_non_compliant_instance_ids(config_client):
+    instance_ids = set()
+    kwargs = {
+        "ConfigRuleName": DETECTIVE_RULE_NAME,
+        "ComplianceTypes": ["NON_COMPLIANT"],
+        "Limit": COMPLIANCE_DETAILS_PAGE_SIZE,
+    }
+    while True:
+        details = call_with_backoff(config_client.get_compliance_details_by_config_rule, **kwargs)
         for detail in details["EvaluationResults"]:
-            instanceIds.append(detail["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"])
-        # Stop each instance that is non_compliant.
-        for instanceId in instanceIds:
-            ec2.stop_instances(InstanceIds=instanceId)
\ No newline at end of file
+            qualifier = detail["EvaluationResultIdentifier"]["EvaluationResultQualifier"]
+            if qualifier["ResourceType"] == "AWS::EC2::Instance":
+                instance_ids.add(qualifier["ResourceId"])
+        if not details.get("NextToken"):
+            return sorted(instance_ids)
+        kwargs["NextToken"] = details["NextToken"]
+
+
+# Return the instances that are running, in batches of IDs. Filtering on the ID rather than passing InstanceIds
+# ignores instances that no longer exist instead of failing the whole call.
+def get_running_instance_ids(ec2, instance_ids):
+    running_instance_ids = []
+    for start in range(0, len(instance_ids), EC2_BATCH_SIZE):
+        kwargs = {
+            "Filters": [
+                {"Name": "instance-id", "Values": instance_ids[start:start + EC2_BATCH_SIZE]},
+                {"Name": "instance-state-name", "Values": ["running"]},
+            ]
+        }
+        while True:
+            response = call_with_backoff(ec2.describe_instances, **kwargs)
+            for reservation in response["Reservations"]:
+                for instance in reservation["Instances"]:
+                    running_instance_ids.append(instance["InstanceId"])
+            if not response.get("NextToken"):
+                break
+            kwargs["NextToken"] = response["NextToken"]
+    return running_instance_ids
+
+
+# Stop the instances in batches and return the IDs that were stopped and those that failed.
+def stop_instances(ec2, instance_ids):
+    stopped_instance_ids = []
+    failed_instance_ids = []
+    for start in range(0, len(instance_ids), EC2_BATCH_SIZE):
+        batch = instance_ids[start:start + EC2_BATCH_SIZE]
+        try:
+            call_with_backoff(ec2.stop_instances, InstanceIds=batch)
+            stopped_instance_ids.extend(batch)
+        except ClientError as e:
+            # One instance changing state since it was described fails the whole batch, so stop them one by one.
+            if e.response["Error"]["Code"] != "IncorrectInstanceState":
+                failed_instance_ids.extend(batch)
+                continue
+            for instance_id in batch:
+                try:
+                    call_with_backoff(ec2.stop_instances, InstanceIds=[instance_id])
+                    stopped_instance_ids.append(instance_id)
+                except ClientError:
+                    failed_instance_ids.append(instance_id)
+    return stopped_instance_ids, failed_instance_ids
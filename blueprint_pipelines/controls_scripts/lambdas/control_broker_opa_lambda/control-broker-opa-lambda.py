@@ -1,14 +1,26 @@
 import os
 import json
 import boto3
+import collections
+import ctypes
+import functools
+import hashlib
+import http.client
 import logging
-from botocore.exceptions import ClientError
+import random
+import shutil
+from botocore.exceptions import BotoCoreError, ClientError
 import subprocess
+import tarfile
 import tempfile
+import time
+import urllib.parse
+import zipfile
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+# Messages are formatted lazily, so messages below LOG_LEVEL cost nothing
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 handler = logging.StreamHandler()
 logger.addHandler(handler)
 formatter = logging.Formatter(
@@ -16,6 +28,159 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.propagate = False
 
+# Policies are cached in /tmp and in memory for the life of the execution
+# environment, keyed by bucket, key and ETag. A cached policy is used without
+# calling S3 until it is older than the TTL, after which it is revalidated
+# with a conditional GET.
+POLICY_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'rego_policies')
+POLICY_CACHE_TTL_SECONDS = float(os.environ.get('POLICY_CACHE_TTL_SECONDS', '300'))
+policy_cache = {}
+
+# With the 'server' engine, one OPA server is started on localhost on the first
+# invocation and kept running for the life of the execution environment, so
+# warm invocations only pay for an HTTP request instead of an `opa eval`
+# process. Set OPA_SERVER_URL to use an already running OPA server instead,
+# e.g. when testing the handler locally.
+OPA_ENGINE = os.environ.get('OPA_ENGINE', 'subprocess')
+OPA_SERVER_URL = os.environ.get('OPA_SERVER_URL')
+OPA_SERVER_ADDRESS = 'localhost:8181'
+OPA_SERVER_STARTUP_TIMEOUT_SECONDS = 5
+
+# With the 'wasm' engine, policies are compiled to OPA's Wasm target when the
+# Config rule is synthesized and evaluated in-process with wasmtime. Loaded
+# policies are cached for the life of the execution environment, keyed by
+# bundle file and entrypoint.
+WASM_POLICY_FILENAME = 'policy.wasm'
+WASM_DATA_FILENAME = 'data.json'
+wasm_policies = {}
+
+# boto3 clients are created once per execution environment and reused, with
+# their connection pools, by every invocation.
+clients = {}
+
+# When PRIME_ON_INIT is set, the policies of the Config rules in PRIME_POLICIES
+# (their rule parameters, set by ControlBroker) are downloaded and evaluated
+# once while the execution environment initializes, so the first invocation
+# finds the clients, the policy cache and the OPA engine already warm.
+PRIME_ON_INIT = os.environ.get('PRIME_ON_INIT', 'false').lower() == 'true'
+PRIME_POLICIES = json.loads(os.environ.get('PRIME_POLICIES', '[]'))
+
+# In bundled mode, one Config rule evaluates the policy bundle built by
+# ControlBroker. Its index routes each resource type to the policies that
+# apply to it, which are all evaluated with a single OPA query.
+POLICY_BUNDLE_KEY_PARAMETER = 'OPA_POLICY_BUNDLE_KEY'
+POLICY_BUNDLE_INDEX_FILENAME = 'index.json'
+POLICY_BUNDLE_ALL_RESOURCE_TYPES = '*'
+policy_bundles = {}
+
+# Ad-hoc OPA queries bind their result to this variable
+QUERY_RESULT_VAR = 'compliance'
+# Evaluates an expression against every configuration item of an input
+# document mapping resource ids to configuration items
+BATCH_QUERY_TEMPLATE = '{{resource_id: verdict | item := input[resource_id]; ' \
+                       'verdict := {expression} with input as item}}'
+
+# Verdicts are memoized by a fingerprint of the configuration item and the
+# version of the policies evaluating it, so items that Config re-delivers
+# without changes to the evaluated fields (periodic triggers, relationship
+# only changes) don't run OPA again. VERDICT_CACHE_BACKEND is 'memory' for an
+# LRU cache per execution environment, 'dynamodb' to share verdicts between
+# execution environments through VERDICT_CACHE_TABLE, or 'none'.
+VERDICT_CACHE_BACKEND = os.environ.get('VERDICT_CACHE_BACKEND', 'memory')
+VERDICT_CACHE_MAX_ENTRIES = int(os.environ.get('VERDICT_CACHE_MAX_ENTRIES', '1024'))
+VERDICT_CACHE_TABLE = os.environ.get('VERDICT_CACHE_TABLE')
+VERDICT_CACHE_TTL_SECONDS = int(os.environ.get('VERDICT_CACHE_TTL_SECONDS', '86400'))
+# Points the dynamodb backend at a local stand-in such as DynamoDB Local
+VERDICT_CACHE_ENDPOINT_URL = os.environ.get('VERDICT_CACHE_ENDPOINT_URL')
+FINGERPRINT_EXCLUDED_FIELDS = os.environ.get(
+    'FINGERPRINT_EXCLUDED_FIELDS',
+    'configurationItemCaptureTime,configurationStateId,configurationItemMD5Hash,'
+    'relationships,relatedEvents'
+).split(',')
+verdict_cache_stats = {'hits': 0, 'misses': 0}
+
+# ScheduledNotification events start a sweep, which evaluates every resource
+# in the rule's scope. Resources are read with Config's batch APIs and
+# evaluated SWEEP_BATCH_SIZE at a time with one OPA query. When less than
+# SWEEP_TIME_MARGIN_SECONDS are left, the sweep checkpoints its position into
+# the event and invokes the function again to continue from there.
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', '1000'))
+SWEEP_TIME_MARGIN_SECONDS = float(os.environ.get('SWEEP_TIME_MARGIN_SECONDS', '10'))
+SWEEP_CHECKPOINT_KEY = 'sweepCheckpoint'
+LIST_DISCOVERED_RESOURCES_LIMIT = 100
+BATCH_GET_RESOURCE_CONFIG_MAX_KEYS = 100
+PUT_EVALUATIONS_MAX_BATCH_SIZE = 100
+# Evaluations Config fails to record are sent again, with a jittered
+# exponential backoff, up to this many attempts in all
+PUT_EVALUATIONS_MAX_ATTEMPTS = 5
+PUT_EVALUATIONS_BASE_DELAY_SECONDS = 0.5
+PUT_EVALUATIONS_MAX_DELAY_SECONDS = 10
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException',
+                          'TooManyRequestsException')
+
+# In the queue topology, Config invokes enqueue_handler, which only forwards
+# each event to QUEUE_URL, and queue_handler consumes the queue in batches.
+QUEUE_URL = os.environ.get('QUEUE_URL')
+# The maxReceiveCount of the queue's redrive policy, set by ControlBroker.
+# Events still failing on their last receive go to the dead letter queue.
+QUEUE_MAX_RECEIVE_COUNT = int(os.environ.get('QUEUE_MAX_RECEIVE_COUNT', '5'))
+
+# The time each invocation spends in each phase (EventParse, PolicyFetch,
+# InputWrite, OpaEval and PutEvaluations) is printed at its end in the
+# CloudWatch embedded metric format, which CloudWatch Logs turns into metrics
+# in METRICS_NAMESPACE with the OPA engine as dimension.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ControlBroker')
+phase_timings = {}
+
+
+class PhaseTimer(object):
+    """Adds the time spent in a block, or in calls to a decorated function,
+    to the phase's total for the current invocation."""
+
+    def __init__(self, phase) -> None:
+        self.phase = phase
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        phase_timings[self.phase] = phase_timings.get(self.phase, 0) + \
+            (time.perf_counter() - self.started_at) * 1000
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with PhaseTimer(self.phase):
+                return function(*args, **kwargs)
+        return timed
+
+
+def emit_metrics(config_rule_name):
+    """Print the phase timings of the invocation and reset them."""
+    if METRICS_ENABLED and phase_timings:
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Engine']],
+                    'Metrics': [{'Name': phase, 'Unit': 'Milliseconds'}
+                                for phase in sorted(phase_timings)]
+                }]
+            },
+            'Engine': OPA_ENGINE
+        }
+        if config_rule_name:
+            record['ConfigRuleName'] = config_rule_name
+        record.update(phase_timings)
+        # Printed rather than logged, since only log lines that are a JSON
+        # document are parsed
+        print(json.dumps(record), flush=True)
+    phase_timings.clear()
+
 
 class Opa(object):
     def __init__(self, input_file_name, policy_package_name, rule_to_eval) -> None:
@@ -27,22 +192,22 @@ class Opa(object):
             logger.error(e)
             raise
         else:
-            logger.info('OPA input query: {}'.format(self.query))
+            logger.info('OPA input query: %s', self.query)
 
     def eval_compliance(self, policy_file_path) -> bool:
         try:
             command = 'opa eval -d {} -i {} {}'.format(policy_file_path,
                                                        self.input_file_path,
                                                        self.query)
-            logger.debug('OPA eval command: {}'.format(command))
+            logger.debug('OPA eval command: %s', command)
             output = run_process(command)
             for result in output['result']:
                 for _ in result['expressions']:
-                    logger.debug('OPA output query: {}'.format(_['text']))
+                    logger.debug('OPA output query: %s', _['text'])
                     if '"{}"'.format(_['text']) == self.query:
                         compliance = _['value']
                         logger.debug(
-                            'OPA output compliance: {}'.format(compliance)
+                            'OPA output compliance: %s', compliance
                         )
                         logger.info('OPA compliance evaluated successfully')
                         return compliance
@@ -51,24 +216,323 @@ class Opa(object):
             raise
 
 
+class OpaServer(object):
+    def __init__(self, url=None) -> None:
+        self.url = url
+        self.process = None
+        self.connection = None
+        self.loaded_policies = {}
+
+    def ensure_running(self) -> None:
+        if self.url or (self.process and self.process.poll() is None):
+            return
+        if self.process:
+            logger.warning('OPA server exited with code %s, restarting',
+                           self.process.returncode)
+        self.close_connection()
+        self.loaded_policies = {}
+        self.process = subprocess.Popen(
+            ['opa', 'run', '--server', '--addr', OPA_SERVER_ADDRESS,
+             '--log-level', 'error'],
+            stdout=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + OPA_SERVER_STARTUP_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                status, _ = self.request('GET', '/health')
+            except (OSError, http.client.HTTPException):
+                status = None
+            if status == 200:
+                logger.info('OPA server started on %s', OPA_SERVER_ADDRESS)
+                return
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.05)
+        self.process.kill()
+        raise RuntimeError('OPA server did not become healthy on {}'.format(
+            OPA_SERVER_ADDRESS))
+
+    def request(self, method, path, body=None):
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                address = urllib.parse.urlsplit(self.url).netloc if self.url \
+                    else OPA_SERVER_ADDRESS
+                self.connection = http.client.HTTPConnection(address, timeout=10)
+            try:
+                self.connection.request(method, path, body=body)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                self.close_connection()
+                # A keep-alive connection may have gone stale while the
+                # execution environment was frozen, so retry once on a new one
+                if attempt or not reused:
+                    raise
+
+    def close_connection(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def load_policy(self, policy_id, policy_file_path) -> None:
+        """Upload the policy unless this version of it is already loaded."""
+        with open(policy_file_path, 'rb') as f:
+            policy = f.read()
+        policy_hash = hashlib.sha256(policy).hexdigest()
+        if self.loaded_policies.get(policy_id) == policy_hash:
+            return
+        status, body = self.request(
+            'PUT', '/v1/policies/{}'.format(policy_id), body=policy)
+        if status != 200:
+            raise RuntimeError('Loading policy {} failed with {}: {}'.format(
+                policy_id, status, body.decode('utf-8')))
+        self.loaded_policies[policy_id] = policy_hash
+        logger.info('Policy %s loaded into the OPA server', policy_id)
+
+    @PhaseTimer('OpaEval')
+    def eval_compliance(self, policy_file_path, policy_package_name,
+                        rule_to_eval, config_item) -> bool:
+        try:
+            self.ensure_running()
+            # Policies are loaded under their package name, so a new version
+            # of a policy replaces the old one instead of conflicting with it
+            self.load_policy(policy_package_name, policy_file_path)
+            path = '/v1/data/{}/{}'.format(
+                policy_package_name.replace('.', '/'), rule_to_eval)
+            status, body = self.request(
+                'POST', path, body=json.dumps({'input': config_item}))
+            if status != 200:
+                raise RuntimeError('OPA query {} failed with {}: {}'.format(
+                    path, status, body.decode('utf-8')))
+            compliance = json.loads(body).get('result')
+            logger.debug('OPA output compliance: %s', compliance)
+            logger.info('OPA compliance evaluated successfully')
+            return compliance
+        except Exception as e:
+            logger.error(e)
+            raise
+
+    @PhaseTimer('OpaEval')
+    def query(self, policy_files, query, input_document):
+        """Return the bindings of the first result of an ad-hoc query."""
+        try:
+            self.ensure_running()
+            for policy_id, policy_file_path in policy_files.items():
+                self.load_policy(policy_id, policy_file_path)
+            status, body = self.request('POST', '/v1/query', body=json.dumps(
+                {'query': query, 'input': input_document}))
+            if status != 200:
+                raise RuntimeError('OPA query {} failed with {}: {}'.format(
+                    query, status, body.decode('utf-8')))
+            results = json.loads(body).get('result', [])
+            return results[0] if results else {}
+        except Exception as e:
+            logger.error(e)
+            raise
+
+
+opa_server = OpaServer(OPA_SERVER_URL)
+
+
+class WasmPolicy(object):
+    """A policy compiled to Wasm by `opa build -t wasm`, using OPA's Wasm ABI."""
+
+    def __init__(self, bundle_path, entrypoint) -> None:
+        import wasmtime
+
+        with tarfile.open(bundle_path) as bundle:
+            files = {member.name.lstrip('/'): member
+                     for member in bundle.getmembers()}
+            wasm = bundle.extractfile(files[WASM_POLICY_FILENAME]).read()
+            data = {}
+            if WASM_DATA_FILENAME in files:
+                data = json.load(bundle.extractfile(files[WASM_DATA_FILENAME]))
+        self.store = wasmtime.Store()
+        module = wasmtime.Module(self.store.engine, wasm)
+        imports = []
+        for import_type in module.imports:
+            if import_type.name == 'memory':
+                self.memory = wasmtime.Memory(self.store, import_type.type)
+                imports.append(self.memory)
+            else:
+                imports.append(wasmtime.Func(
+                    self.store, import_type.type,
+                    getattr(self, import_type.name, self.opa_builtin)))
+        instance = wasmtime.Instance(self.store, module, imports)
+        self.exports = instance.exports(self.store)
+
+        builtins = self.dump_json(self.call('builtins'))
+        if builtins:
+            raise ValueError(
+                'Policy needs builtins the Wasm engine does not provide: '
+                '{}'.format(', '.join(sorted(builtins))))
+        entrypoints = self.dump_json(self.call('entrypoints'))
+        self.entrypoint_id = entrypoints[entrypoint]
+        self.data_address = self.load_json(data)
+        self.heap_pointer = self.call('opa_heap_ptr_get')
+
+    def opa_abort(self, address):
+        raise RuntimeError('OPA Wasm policy aborted: {}'.format(
+            self.read_string(address)))
+
+    def opa_println(self, address):
+        logger.debug('OPA Wasm policy: %s', self.read_string(address))
+
+    def opa_builtin(self, builtin_id, *args):
+        raise RuntimeError(
+            'OPA Wasm policy called unsupported builtin {}'.format(builtin_id))
+
+    def call(self, name, *args):
+        return self.exports[name](self.store, *args)
+
+    def memory_base(self):
+        # Looked up on every access since the memory moves when it grows
+        return ctypes.addressof(self.memory.data_ptr(self.store).contents)
+
+    def read_string(self, address):
+        return ctypes.string_at(self.memory_base() + address).decode('utf-8')
+
+    def load_json(self, value):
+        raw = json.dumps(value).encode('utf-8')
+        address = self.call('opa_malloc', len(raw))
+        ctypes.memmove(self.memory_base() + address, raw, len(raw))
+        value_address = self.call('opa_json_parse', address, len(raw))
+        if value_address == 0:
+            raise RuntimeError('OPA Wasm policy failed to parse JSON')
+        return value_address
+
+    def dump_json(self, value_address):
+        return json.loads(self.read_string(
+            self.call('opa_json_dump', value_address)))
+
+    @PhaseTimer('OpaEval')
+    def eval_compliance(self, config_item) -> bool:
+        try:
+            # Drop everything allocated by previous evaluations
+            self.call('opa_heap_ptr_set', self.heap_pointer)
+            input_address = self.load_json(config_item)
+            context = self.call('opa_eval_ctx_new')
+            self.call('opa_eval_ctx_set_input', context, input_address)
+            self.call('opa_eval_ctx_set_data', context, self.data_address)
+            self.call('opa_eval_ctx_set_entrypoint', context,
+                      self.entrypoint_id)
+            error = self.call('eval', context)
+            if error:
+                raise RuntimeError(
+                    'OPA Wasm evaluation failed with code {}'.format(error))
+            results = self.dump_json(
+                self.call('opa_eval_ctx_get_result', context))
+            compliance = results[0]['result'] if results else None
+            logger.debug('OPA output compliance: %s', compliance)
+            logger.info('OPA compliance evaluated successfully')
+            return compliance
+        except Exception as e:
+            logger.error(e)
+            raise
+
+
+def get_wasm_policy(bundle_path, entrypoint) -> WasmPolicy:
+    """Return the loaded Wasm policy, reloading it if the bundle changed."""
+    version = os.stat(bundle_path).st_mtime_ns
+    cached = wasm_policies.get((bundle_path, entrypoint))
+    if cached and cached['version'] == version:
+        return cached['policy']
+    policy = WasmPolicy(bundle_path, entrypoint)
+    wasm_policies[(bundle_path, entrypoint)] = {
+        'policy': policy,
+        'version': version
+    }
+    logger.info('Wasm policy %s loaded', entrypoint)
+    return policy
+
+
+class PolicyBundle(object):
+    def __init__(self, archive_path) -> None:
+        self.path = os.path.splitext(archive_path)[0]
+        shutil.rmtree(self.path, ignore_errors=True)
+        with zipfile.ZipFile(archive_path) as archive:
+            archive.extractall(self.path)
+        with open(os.path.join(self.path, POLICY_BUNDLE_INDEX_FILENAME)) as f:
+            self.index = json.load(f)
+        logger.info('Policy bundle %s with %s policies ready',
+                    self.index['version'], len(self.index['policies']))
+
+    def policies_for(self, resource_type):
+        resource_types = self.index['resource_types']
+        names = resource_types.get(resource_type, []) + resource_types.get(
+            POLICY_BUNDLE_ALL_RESOURCE_TYPES, [])
+        return {name: self.index['policies'][name] for name in names}
+
+    def policy_file_path(self, policy):
+        return os.path.join(self.path, policy['file'])
+
+    def policy_files(self, policies):
+        return {policy['package']: os.path.join(self.path, policy['file'])
+                for policy in policies.values()}
+
+    def expression(self, policies):
+        """Return a rego object of the verdicts of the policies, by name.
+
+        Each verdict is wrapped in an array, empty when the policy's rule is
+        undefined, so that one undefined rule doesn't leave the whole object
+        undefined."""
+        return '{{{}}}'.format(', '.join(
+            '{}: [value | value := data.{}.{}]'.format(
+                json.dumps(name), policy['package'], policy['rule'])
+            for name, policy in sorted(policies.items())
+        ))
+
+    @staticmethod
+    def verdicts(policies, values):
+        """Return the verdicts of the policies from the values of expression,
+        False for undefined rules."""
+        return {name: values[name][0] if values.get(name) else False
+                for name in policies}
+
+    def eval_compliance(self, config_item):
+        """Return the verdict of every policy for the item's resource type.
+
+        Returns an empty dict, without running OPA, when no policy applies."""
+        policies = self.policies_for(config_item.get('resourceType'))
+        if not policies:
+            return {}
+        verdicts = self.verdicts(policies, run_opa_query(
+            self.policy_files(policies), self.expression(policies),
+            config_item) or {})
+        logger.debug('OPA bundle verdicts: %s', verdicts)
+        return verdicts
+
+
+def get_policy_bundle(archive_path) -> PolicyBundle:
+    """Return the unpacked policy bundle, unpacking it again if it changed."""
+    version = os.stat(archive_path).st_mtime_ns
+    cached = policy_bundles.get(archive_path)
+    if cached and cached['version'] == version:
+        return cached['bundle']
+    bundle = PolicyBundle(archive_path)
+    policy_bundles[archive_path] = {'bundle': bundle, 'version': version}
+    return bundle
+
+
 class Config(object):
     def __init__(self, event) -> None:
         self.config_event = json.loads(event['invokingEvent'])
         self.config_item = self.config_event['configurationItem']
-        logger.debug('Config Item: {}'.format(self.config_item))
+        logger.debug('Config Item: %s', self.config_item)
         self.result_token = event['resultToken']
-        logger.debug('Result token: {}'.format(self.result_token))
+        logger.debug('Result token: %s', self.result_token)
         self.input_parameters = json.loads(event['ruleParameters'])
-        logger.debug('Config rule parameters: {}'.format(self.input_parameters))
+        logger.debug('Config rule parameters: %s', self.input_parameters)
         self.message_type = self.config_event['messageType']
-        logger.debug('Config message type: {}'.format(self.message_type))
+        logger.debug('Config message type: %s', self.message_type)
         self.resource_id = self.config_item['resourceId']
-        logger.debug('AWS resource id: {}'.format(self.resource_id))
+        logger.debug('AWS resource id: %s', self.resource_id)
         self.resource_status = self.config_item['configurationItemStatus']
-        logger.debug('AWS resource status: {}'.format(self.resource_status))
-        self.client = boto3.client('config')
+        logger.debug('AWS resource status: %s', self.resource_status)
+        self.client = get_client('config')
 
-    def set_compliance(self, compliance) -> None:
+    def set_compliance(self, compliance, applicable=True) -> None:
         evaluation = {
             'Annotation': 'Setting compliance based on OPA policy evaluation.\n',
             'ComplianceResourceType': self.config_item['resourceType'],
@@ -81,6 +545,13 @@ class Config(object):
                   'NOT_APPLICABLE.'.format(self.resource_id)
             logger.info(msg)
             evaluation['Annotation'] += msg
+        elif not applicable:
+            evaluation['ComplianceType'] = 'NOT_APPLICABLE'
+            msg = 'No policy applies to resource type {}, setting Compliance ' \
+                  'Status to NOT_APPLICABLE.'.format(
+                      self.config_item['resourceType'])
+            logger.info(msg)
+            evaluation['Annotation'] += msg
         elif compliance:
             evaluation['ComplianceType'] = 'COMPLIANT'
             msg = 'Resource {} is compliant'.format(self.resource_id)
@@ -92,31 +563,141 @@ class Config(object):
             logger.info(msg)
             evaluation['Annotation'] += msg
         try:
-            self.client.put_evaluations(Evaluations=[evaluation],
-                                        ResultToken=self.result_token)
+            with PhaseTimer('PutEvaluations'):
+                self.client.put_evaluations(Evaluations=[evaluation],
+                                            ResultToken=self.result_token)
         except ClientError as e:
             logger.error(
-                'Config service PUT Evaluation failed with error: {}'.format(
-                    e.response['Error']['Message']
-                )
+                'Config service PUT Evaluation failed with error: %s',
+                e.response['Error']['Message']
+            )
+
+
+def get_client(service_name, endpoint_url=None):
+    client = clients.get((service_name, endpoint_url))
+    if client is None:
+        client = boto3.client(service_name, endpoint_url=endpoint_url)
+        clients[(service_name, endpoint_url)] = client
+    return client
+
+
+class LruVerdictCache(object):
+    def __init__(self, max_entries) -> None:
+        self.max_entries = max_entries
+        self.verdicts = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.verdicts:
+            return None
+        self.verdicts.move_to_end(key)
+        return self.verdicts[key]
+
+    def put(self, key, verdict) -> None:
+        self.verdicts[key] = verdict
+        self.verdicts.move_to_end(key)
+        while len(self.verdicts) > self.max_entries:
+            self.verdicts.popitem(last=False)
+
+
+class DynamoDbVerdictCache(object):
+    """Verdicts in a DynamoDB table keyed by 'fingerprint', expired by TTL."""
+
+    def __init__(self, table_name, ttl_seconds, endpoint_url=None) -> None:
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.endpoint_url = endpoint_url
+
+    def get(self, key):
+        try:
+            response = get_client('dynamodb', self.endpoint_url).get_item(
+                TableName=self.table_name,
+                Key={'fingerprint': {'S': key}}
             )
+        # Connection and parameter errors are BotoCoreErrors, not ClientErrors
+        except (ClientError, BotoCoreError) as e:
+            logger.warning('Verdict cache lookup failed: %s', e)
+            return None
+        item = response.get('Item')
+        # DynamoDB deletes expired items lazily
+        if item is None or int(item['expires_at']['N']) < time.time():
+            return None
+        return {'verdict': json.loads(item['verdict']['S'])}
+
+    def put(self, key, verdict) -> None:
+        try:
+            get_client('dynamodb', self.endpoint_url).put_item(
+                TableName=self.table_name,
+                Item={
+                    'fingerprint': {'S': key},
+                    'verdict': {'S': json.dumps(verdict['verdict'])},
+                    'expires_at': {'N': str(int(time.time()) + self.ttl_seconds)}
+                }
+            )
+        except (ClientError, BotoCoreError) as e:
+            logger.warning('Verdict cache update failed: %s', e)
+
 
+def get_verdict_cache():
+    if VERDICT_CACHE_BACKEND == 'memory':
+        return LruVerdictCache(VERDICT_CACHE_MAX_ENTRIES)
+    if VERDICT_CACHE_BACKEND == 'dynamodb':
+        if not VERDICT_CACHE_TABLE:
+            logger.warning('VERDICT_CACHE_TABLE is not set, caching verdicts '
+                           'in memory instead')
+            return LruVerdictCache(VERDICT_CACHE_MAX_ENTRIES)
+        return DynamoDbVerdictCache(VERDICT_CACHE_TABLE,
+                                    VERDICT_CACHE_TTL_SECONDS,
+                                    VERDICT_CACHE_ENDPOINT_URL)
+    return None
 
+
+verdict_cache = get_verdict_cache()
+
+
+@PhaseTimer('PolicyFetch')
 def download_s3_obj(bucket, prefix, object_key) -> str:
+    """Return the path to a local copy of the S3 object, using the policy cache."""
+    object_path = ''.join([prefix, object_key])
+    cache_key = (bucket, object_path)
+    cached = policy_cache.get(cache_key)
+    now = time.monotonic()
+    if cached and now - cached['validated_at'] < POLICY_CACHE_TTL_SECONDS:
+        logger.debug('Using cached policy %s from %s', object_path, bucket)
+        return cached['file_path']
+    get_object_kwargs = {'Bucket': bucket, 'Key': object_path}
+    if cached:
+        get_object_kwargs['IfNoneMatch'] = cached['etag']
     try:
-        s3 = boto3.resource('s3')
-        object_path = ''.join([prefix, object_key])
-        obj = s3.Object(bucket, object_path)
-        obj_body = obj.get()['Body'].read().decode('utf-8')
+        response = get_client('s3').get_object(**get_object_kwargs)
     except ClientError as e:
-        logger.error('S3 download file failed with: {}'.format(
-            e.response['Error']['Message']))
-    except Exception as e:
-        logger.error(e)
-    else:
-        return obj_body
+        if cached and e.response['ResponseMetadata']['HTTPStatusCode'] == 304:
+            logger.debug('Cached policy %s from %s is still current',
+                         object_path, bucket)
+            cached['validated_at'] = now
+            return cached['file_path']
+        logger.error('S3 download file failed with: %s',
+                     e.response['Error']['Message'])
+        raise
+    os.makedirs(POLICY_CACHE_DIR, exist_ok=True)
+    file_name = hashlib.sha256(
+        '{}/{}'.format(bucket, object_path).encode('utf-8')).hexdigest()
+    file_path = os.path.join(POLICY_CACHE_DIR, '{}{}'.format(
+        file_name, os.path.splitext(object_path)[1]))
+    tmp_file_path = '{}.tmp'.format(file_path)
+    with open(tmp_file_path, 'wb') as f:
+        f.write(response['Body'].read())
+    os.replace(tmp_file_path, file_path)
+    policy_cache[cache_key] = {
+        'etag': response['ETag'],
+        'file_path': file_path,
+        'validated_at': now
+    }
+    logger.info('Policy %s from %s downloaded to the policy cache',
+                object_path, bucket)
+    return file_path
 
 
+@PhaseTimer('OpaEval')
 def run_process(command):
     try:
         process = subprocess.run(
@@ -126,61 +707,573 @@ def run_process(command):
             encoding='utf-8'
         )
     except BrokenPipeError as e:
-        logger.error('Process failed with {}'.format(e))
+        logger.error('Process failed with %s', e)
         raise
     except Exception as e:
-        logger.error('Process failed with {}'.format(e))
+        logger.error('Process failed with %s', e)
         raise
     else:
         output = json.loads(process.stdout)
-        logger.debug('Shell command stdout: {}'.format(output))
+        logger.debug('Shell command stdout: %s', output)
         return output
 
 
+def run_opa_query(policy_files, expression, input_document):
+    """Evaluate a rego expression with the given policies loaded.
+
+    policy_files maps policy ids to policy files. Returns None when the
+    expression is undefined."""
+    query = '{} := {}'.format(QUERY_RESULT_VAR, expression)
+    logger.debug('OPA query: %s', query)
+    if OPA_ENGINE == 'server':
+        bindings = opa_server.query(policy_files, query, input_document)
+    else:
+        input_file = get_tempfile(json.dumps(input_document))
+        try:
+            output = run_process('opa eval {} -i {} \'{}\''.format(
+                ' '.join('-d {}'.format(policy_file_path)
+                         for policy_file_path in policy_files.values()),
+                input_file.name, query))
+        finally:
+            input_file.close()
+        results = output.get('result', [])
+        bindings = results[0]['bindings'] if results else {}
+    return bindings.get(QUERY_RESULT_VAR)
+
+
+@PhaseTimer('InputWrite')
 def get_tempfile(content):
     try:
         tf = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8')
         tf.write(content)
         tf.seek(0)
     except Exception as e:
-        logger.error('Creating tempfile failed with {}'.format(e))
+        logger.error('Creating tempfile failed with %s', e)
         raise
     else:
         return tf
 
 
-def lambda_handler(event, context):
-    try:
-        logger.debug('Lambda event: {}'.format(event))
-        config = Config(event)
-        logger.info('Config input processed')
+def evaluate_compliance(input_parameters, config_item):
+    if OPA_ENGINE == 'wasm':
+        bundle_path = download_s3_obj(
+            input_parameters['ASSETS_BUCKET'],
+            input_parameters['REGO_POLICIES_PREFIX'],
+            input_parameters['OPA_WASM_BUNDLE_KEY']
+        )
+        policy = get_wasm_policy(bundle_path, '{}/{}'.format(
+            input_parameters['OPA_POLICY_PACKAGE_NAME'].replace('.', '/'),
+            input_parameters['OPA_POLICY_RULE_TO_EVAL']
+        ))
+        return policy.eval_compliance(config_item)
 
-        input_file = get_tempfile(json.dumps(config.config_item))
-        logger.info('OPA input file created')
-        logger.debug('Name of the input file is: {}'.format(input_file.name))
+    policy_file_path = download_s3_obj(
+        input_parameters['ASSETS_BUCKET'],
+        input_parameters['REGO_POLICIES_PREFIX'],
+        input_parameters['REGO_POLICY_KEY']
+    )
+    logger.info('OPA policy file ready')
+    logger.debug('Name of the policy file is: %s', policy_file_path)
 
-        policy_file = get_tempfile(download_s3_obj(
-            config.input_parameters['ASSETS_BUCKET'],
-            config.input_parameters['REGO_POLICIES_PREFIX'],
-            config.input_parameters['REGO_POLICY_KEY']
-        ))
-        logger.info('OPA policy file created')
-        logger.debug('Name of the policy file is: {}'.format(policy_file.name))
+    if OPA_ENGINE == 'server':
+        return opa_server.eval_compliance(
+            policy_file_path,
+            input_parameters['OPA_POLICY_PACKAGE_NAME'],
+            input_parameters['OPA_POLICY_RULE_TO_EVAL'],
+            config_item
+        )
 
+    input_file = get_tempfile(json.dumps(config_item))
+    logger.info('OPA input file created')
+    logger.debug('Name of the input file is: %s', input_file.name)
+    try:
         opa = Opa(
             input_file.name,
-            config.input_parameters['OPA_POLICY_PACKAGE_NAME'],
-            config.input_parameters['OPA_POLICY_RULE_TO_EVAL']
+            input_parameters['OPA_POLICY_PACKAGE_NAME'],
+            input_parameters['OPA_POLICY_RULE_TO_EVAL']
         )
-
-        config.set_compliance(opa.eval_compliance(policy_file.name))
+        return opa.eval_compliance(policy_file_path)
     finally:
+        input_file.close()
+        logger.info("Temp file has been closed")
+
+
+def evaluate_policy_bundle(input_parameters, config_item):
+    bundle = get_policy_bundle(download_s3_obj(
+        input_parameters['ASSETS_BUCKET'],
+        input_parameters['REGO_POLICIES_PREFIX'],
+        input_parameters[POLICY_BUNDLE_KEY_PARAMETER]
+    ))
+    return bundle.eval_compliance(config_item)
+
+
+def get_policy_version(input_parameters):
+    """Return the S3 keys and ETags of the policies the rule evaluates."""
+    if POLICY_BUNDLE_KEY_PARAMETER in input_parameters:
+        key_parameter = POLICY_BUNDLE_KEY_PARAMETER
+    elif OPA_ENGINE == 'wasm':
+        key_parameter = 'OPA_WASM_BUNDLE_KEY'
+    else:
+        key_parameter = 'REGO_POLICY_KEY'
+    bucket = input_parameters['ASSETS_BUCKET']
+    object_path = ''.join([input_parameters['REGO_POLICIES_PREFIX'],
+                           input_parameters[key_parameter]])
+    # Refreshes the cached policy and its ETag once the TTL has passed
+    download_s3_obj(bucket, input_parameters['REGO_POLICIES_PREFIX'],
+                    input_parameters[key_parameter])
+    return [bucket, object_path, policy_cache[(bucket, object_path)]['etag'],
+            input_parameters.get('OPA_POLICY_PACKAGE_NAME'),
+            input_parameters.get('OPA_POLICY_RULE_TO_EVAL')]
+
+
+def fingerprint(input_parameters, config_item):
+    evaluated_fields = {
+        field: value for field, value in config_item.items()
+        if field not in FINGERPRINT_EXCLUDED_FIELDS
+    }
+    return hashlib.sha256(json.dumps(
+        [get_policy_version(input_parameters), evaluated_fields],
+        sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')).hexdigest()
+
+
+def evaluate_cached(evaluate, input_parameters, config_item):
+    """Return evaluate(input_parameters, config_item), memoized."""
+    if verdict_cache is None:
+        return evaluate(input_parameters, config_item)
+    key = fingerprint(input_parameters, config_item)
+    cached = verdict_cache.get(key)
+    if cached is not None:
+        verdict_cache_stats['hits'] += 1
+        logger.info('Reusing the verdict for fingerprint %s', key)
+        verdict = cached['verdict']
+    else:
+        verdict_cache_stats['misses'] += 1
+        verdict = evaluate(input_parameters, config_item)
+        verdict_cache.put(key, {'verdict': verdict})
+    logger.info('Verdict cache: %s hits, %s misses',
+                verdict_cache_stats['hits'], verdict_cache_stats['misses'])
+    return verdict
+
+
+class AdaptiveBackoff(object):
+    """Paces calls to an API, slowing down whenever it throttles and
+    speeding back up as calls succeed."""
+
+    def __init__(self, max_delay=20.0, max_attempts=10) -> None:
+        self.delay = 0.0
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def call(self, function, **kwargs):
+        for attempt in range(self.max_attempts):
+            if self.delay:
+                time.sleep(random.uniform(self.delay / 2, self.delay))
+            try:
+                response = function(**kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES \
+                        or attempt == self.max_attempts - 1:
+                    raise
+                self.delay = min(self.max_delay, max(0.1, self.delay * 2))
+                logger.warning('Throttled, slowing down to one call per %.1f s',
+                               self.delay)
+                continue
+            self.delay = self.delay / 2 if self.delay > 0.05 else 0.0
+            return response
+
+
+def configuration_item_from_base(base_item):
+    """Return a BaseConfigurationItem in the shape of the configurationItem
+    of change notifications, which the policies are written against."""
+    item = {}
+    for field, value in base_item.items():
+        item[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+    item['configuration'] = json.loads(base_item.get('configuration') or '{}')
+    item['supplementaryConfiguration'] = {}
+    for field, value in base_item.get('supplementaryConfiguration', {}).items():
         try:
-            input_file.close()
-            policy_file.close()
-        except UnboundLocalError as e:
-            logger.error(
-                'Tempfiles not created. Nothing to close. Error: {}'.format(e)
-            )
+            item['supplementaryConfiguration'][field] = json.loads(value)
+        except ValueError:
+            item['supplementaryConfiguration'][field] = value
+    return item
+
+
+def get_sweep_resource_types(config_rule_name, input_parameters):
+    response = get_client('config').describe_config_rules(
+        ConfigRuleNames=[config_rule_name])
+    resource_types = response['ConfigRules'][0].get('Scope', {}).get(
+        'ComplianceResourceTypes', [])
+    if not resource_types and POLICY_BUNDLE_KEY_PARAMETER in input_parameters:
+        resource_types = [
+            resource_type
+            for resource_type in get_policy_bundle(download_s3_obj(
+                input_parameters['ASSETS_BUCKET'],
+                input_parameters['REGO_POLICIES_PREFIX'],
+                input_parameters[POLICY_BUNDLE_KEY_PARAMETER]
+            )).index['resource_types']
+            if resource_type != POLICY_BUNDLE_ALL_RESOURCE_TYPES
+        ]
+    return sorted(resource_types)
+
+
+def fetch_configuration_items(backoff, resource_type, next_token):
+    """Return up to about SWEEP_BATCH_SIZE configuration items of the resource
+    type by resource id, and the token to continue from, if any."""
+    client = get_client('config')
+    resource_keys = []
+    while len(resource_keys) < SWEEP_BATCH_SIZE:
+        kwargs = {'resourceType': resource_type,
+                  'limit': LIST_DISCOVERED_RESOURCES_LIMIT}
+        if next_token:
+            kwargs['nextToken'] = next_token
+        response = backoff.call(client.list_discovered_resources, **kwargs)
+        resource_keys.extend(
+            {'resourceType': resource_type, 'resourceId': resource['resourceId']}
+            for resource in response['resourceIdentifiers'])
+        next_token = response.get('nextToken')
+        if not next_token:
+            break
+    items = {}
+    for start in range(0, len(resource_keys),
+                       BATCH_GET_RESOURCE_CONFIG_MAX_KEYS):
+        keys = resource_keys[start:start + BATCH_GET_RESOURCE_CONFIG_MAX_KEYS]
+        while keys:
+            response = backoff.call(client.batch_get_resource_config,
+                                    resourceKeys=keys)
+            for base_item in response['baseConfigurationItems']:
+                items[base_item['resourceId']] = \
+                    configuration_item_from_base(base_item)
+            keys = response.get('unprocessedResourceKeys', [])
+    return items, next_token
+
+
+def compliance_type(config_item, verdict, applicable=True):
+    if config_item.get('configurationItemStatus') == 'ResourceDeleted' \
+            or not applicable:
+        return 'NOT_APPLICABLE'
+    return 'COMPLIANT' if verdict else 'NON_COMPLIANT'
+
+
+def evaluate_batch(input_parameters, items):
+    """Return the compliance type of every configuration item, by resource id."""
+    if POLICY_BUNDLE_KEY_PARAMETER in input_parameters:
+        bundle = get_policy_bundle(download_s3_obj(
+            input_parameters['ASSETS_BUCKET'],
+            input_parameters['REGO_POLICIES_PREFIX'],
+            input_parameters[POLICY_BUNDLE_KEY_PARAMETER]
+        ))
+        items_by_type = {}
+        for resource_id, item in items.items():
+            items_by_type.setdefault(item['resourceType'], {})[resource_id] = item
+        compliance_types = {}
+        for resource_type, type_items in items_by_type.items():
+            policies = bundle.policies_for(resource_type)
+            values = {}
+            if policies:
+                values = run_opa_query(
+                    bundle.policy_files(policies),
+                    BATCH_QUERY_TEMPLATE.format(
+                        expression=bundle.expression(policies)),
+                    type_items) or {}
+            for resource_id, item in type_items.items():
+                verdicts = bundle.verdicts(policies,
+                                           values.get(resource_id) or {})
+                compliance_types[resource_id] = compliance_type(
+                    item, all(verdicts.values()), bool(policies))
+        return compliance_types
+
+    package_name = input_parameters['OPA_POLICY_PACKAGE_NAME']
+    rule_to_eval = input_parameters['OPA_POLICY_RULE_TO_EVAL']
+    if OPA_ENGINE == 'wasm':
+        policy = get_wasm_policy(
+            download_s3_obj(
+                input_parameters['ASSETS_BUCKET'],
+                input_parameters['REGO_POLICIES_PREFIX'],
+                input_parameters['OPA_WASM_BUNDLE_KEY']
+            ),
+            '{}/{}'.format(package_name.replace('.', '/'), rule_to_eval)
+        )
+        verdicts = {resource_id: policy.eval_compliance(item)
+                    for resource_id, item in items.items()}
+    else:
+        policy_file_path = download_s3_obj(
+            input_parameters['ASSETS_BUCKET'],
+            input_parameters['REGO_POLICIES_PREFIX'],
+            input_parameters['REGO_POLICY_KEY']
+        )
+        verdicts = run_opa_query(
+            {package_name: policy_file_path},
+            BATCH_QUERY_TEMPLATE.format(
+                expression='data.{}.{}'.format(package_name, rule_to_eval)),
+            items) or {}
+    return {resource_id: compliance_type(item, verdicts.get(resource_id))
+            for resource_id, item in items.items()}
+
+
+def put_sweep_evaluations(backoff, result_token, ordering_timestamp, items,
+                          compliance_types):
+    evaluations = [
+        {
+            'ComplianceResourceType': items[resource_id]['resourceType'],
+            'ComplianceResourceId': resource_id,
+            'ComplianceType': compliance_types[resource_id],
+            'Annotation': 'Setting compliance based on OPA policy evaluation '
+                          'in a periodic sweep.',
+            'OrderingTimestamp': ordering_timestamp
+        }
+        for resource_id in sorted(items)
+    ]
+    client = get_client('config')
+    for start in range(0, len(evaluations), PUT_EVALUATIONS_MAX_BATCH_SIZE):
+        batch = evaluations[start:start + PUT_EVALUATIONS_MAX_BATCH_SIZE]
+        for attempt in range(PUT_EVALUATIONS_MAX_ATTEMPTS):
+            if attempt:
+                logger.warning('Retrying %s failed evaluations', len(batch))
+                time.sleep(random.uniform(0, min(
+                    PUT_EVALUATIONS_MAX_DELAY_SECONDS,
+                    PUT_EVALUATIONS_BASE_DELAY_SECONDS * 2 ** attempt)))
+            with PhaseTimer('PutEvaluations'):
+                response = backoff.call(client.put_evaluations,
+                                        Evaluations=batch,
+                                        ResultToken=result_token)
+            # Config reports evaluations it couldn't record, to be sent again
+            batch = response.get('FailedEvaluations', [])
+            if not batch:
+                break
         else:
-            logger.info("Temp files have been closed")
+            logger.error('Config failed to record %s evaluations after %s '
+                         'attempts: %s', len(batch),
+                         PUT_EVALUATIONS_MAX_ATTEMPTS, batch)
+
+
+def sweep(event, context):
+    """Evaluate every resource in the scope of the rule that sent the
+    ScheduledNotification, continuing from its checkpoint if it has one."""
+    invoking_event = json.loads(event['invokingEvent'])
+    input_parameters = json.loads(event['ruleParameters'])
+    checkpoint = event.get(SWEEP_CHECKPOINT_KEY, {
+        'resource_type_index': 0,
+        'next_token': None,
+        'evaluated': 0
+    })
+    resource_types = get_sweep_resource_types(
+        event['configRuleName'], input_parameters)
+    logger.info('Sweeping %s resource types of rule %s from %s',
+                len(resource_types), event['configRuleName'], checkpoint)
+    backoff = AdaptiveBackoff()
+    while checkpoint['resource_type_index'] < len(resource_types):
+        if context is not None and context.get_remaining_time_in_millis() < \
+                SWEEP_TIME_MARGIN_SECONDS * 1000:
+            continue_sweep(event, context, checkpoint)
+            return
+        resource_type = resource_types[checkpoint['resource_type_index']]
+        items, next_token = fetch_configuration_items(
+            backoff, resource_type, checkpoint['next_token'])
+        if items:
+            put_sweep_evaluations(
+                backoff, event['resultToken'],
+                invoking_event['notificationCreationTime'], items,
+                evaluate_batch(input_parameters, items))
+        checkpoint['evaluated'] += len(items)
+        logger.info('Evaluated %s %s resources, %s in total', len(items),
+                    resource_type, checkpoint['evaluated'])
+        if next_token:
+            checkpoint['next_token'] = next_token
+        else:
+            checkpoint['resource_type_index'] += 1
+            checkpoint['next_token'] = None
+    logger.info('Sweep of rule %s evaluated %s resources',
+                event['configRuleName'], checkpoint['evaluated'])
+
+
+def continue_sweep(event, context, checkpoint):
+    logger.info('Running out of time, continuing the sweep from %s',
+                checkpoint)
+    event = dict(event)
+    event[SWEEP_CHECKPOINT_KEY] = checkpoint
+    get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event)
+    )
+
+
+def prime(rule_parameters_list):
+    """Warm the clients, the policy cache and the OPA engine.
+
+    Every policy is evaluated once against an empty input, which loads it into
+    the engine. Failures are logged and left for the invocations to surface."""
+    started_at = time.monotonic()
+    get_client('config')
+    get_client('s3')
+    for rule_parameters in rule_parameters_list:
+        try:
+            if POLICY_BUNDLE_KEY_PARAMETER in rule_parameters:
+                evaluate_policy_bundle(rule_parameters, {})
+            else:
+                evaluate_compliance(rule_parameters, {})
+        except Exception as e:
+            logger.warning('Priming policy %s failed: %s',
+                           rule_parameters.get('OPA_POLICY_PACKAGE_NAME'), e)
+    logger.info('Primed %s policies with the %s engine in %.0f ms',
+                len(rule_parameters_list), OPA_ENGINE,
+                (time.monotonic() - started_at) * 1000)
+    # Priming isn't part of the first invocation's phases
+    phase_timings.clear()
+
+
+def lambda_handler(event, context):
+    try:
+        return handle_event(event, context)
+    finally:
+        emit_metrics(event.get('configRuleName'))
+
+
+def handle_event(event, context):
+    logger.debug('Lambda event: %s', event)
+    # The queue's event source mapping invokes the function with SQS batches
+    if 'Records' in event:
+        return queue_handler(event, context)
+    with PhaseTimer('EventParse'):
+        message_type = json.loads(event['invokingEvent'])['messageType']
+    if message_type == 'ScheduledNotification':
+        sweep(event, context)
+        return
+    with PhaseTimer('EventParse'):
+        config = Config(event)
+    logger.info('Config input processed')
+    if POLICY_BUNDLE_KEY_PARAMETER in config.input_parameters:
+        verdicts = evaluate_cached(
+            evaluate_policy_bundle, config.input_parameters, config.config_item)
+        non_compliant = sorted(
+            name for name, verdict in verdicts.items() if not verdict)
+        if non_compliant:
+            logger.info('Policies not complied with: %s',
+                        ', '.join(non_compliant))
+        config.set_compliance(not non_compliant, applicable=bool(verdicts))
+        return
+    config.set_compliance(evaluate_cached(
+        evaluate_compliance, config.input_parameters, config.config_item))
+
+
+def enqueue_handler(event, context):
+    get_client('sqs').send_message(QueueUrl=QUEUE_URL,
+                                   MessageBody=json.dumps(event))
+
+
+def put_queued_evaluation(backoff, config_event, compliance_type):
+    item = json.loads(config_event['invokingEvent'])['configurationItem']
+    with PhaseTimer('PutEvaluations'):
+        response = backoff.call(
+            get_client('config').put_evaluations,
+            Evaluations=[{
+                'ComplianceResourceType': item['resourceType'],
+                'ComplianceResourceId': item['resourceId'],
+                'ComplianceType': compliance_type,
+                'Annotation': 'Setting compliance based on OPA policy '
+                              'evaluation.',
+                'OrderingTimestamp': item['configurationItemCaptureTime']
+            }],
+            ResultToken=config_event['resultToken']
+        )
+    if response.get('FailedEvaluations'):
+        raise RuntimeError('Config failed to record the evaluation of {}'.format(
+            item['resourceId']))
+
+
+def queue_handler(event, context):
+    """Evaluate a batch of queued Config events and report the failed ones.
+
+    Events of a rule for the same resource are merged into the latest one, and
+    the items of each rule are evaluated with one OPA query."""
+    failed_message_ids = set()
+    # The latest event and the ids of the messages merged into it, by rule and
+    # resource, or by rule for scheduled notifications
+    latest_events = {}
+    for record in event['Records']:
+        try:
+            config_event = json.loads(record['body'])
+            invoking_event = json.loads(config_event['invokingEvent'])
+            if invoking_event['messageType'] == 'ScheduledNotification':
+                key = (config_event['configRuleName'],)
+                timestamp = invoking_event['notificationCreationTime']
+            else:
+                item = invoking_event['configurationItem']
+                key = (config_event['configRuleName'], item['resourceType'],
+                       item['resourceId'])
+                timestamp = item['configurationItemCaptureTime']
+        except (KeyError, ValueError) as e:
+            logger.error('Invalid queued event %s: %s', record['messageId'],
+                         e)
+            failed_message_ids.add(record['messageId'])
+            continue
+        latest = latest_events.setdefault(
+            key, {'event': config_event, 'timestamp': timestamp,
+                  'message_ids': []})
+        latest['message_ids'].append(record['messageId'])
+        if timestamp > latest['timestamp']:
+            latest['event'] = config_event
+            latest['timestamp'] = timestamp
+    logger.info('Merged %s queued events into %s', len(event['Records']),
+                len(latest_events))
+
+    events_by_rule = {}
+    for key, latest in latest_events.items():
+        if len(key) == 1:
+            try:
+                sweep(latest['event'], context)
+            except Exception as e:
+                logger.error('Sweep of rule %s failed: %s', key[0], e)
+                failed_message_ids.update(latest['message_ids'])
+            continue
+        events_by_rule.setdefault(
+            (latest['event']['configRuleName'],
+             latest['event']['ruleParameters']), []).append(latest)
+
+    backoff = AdaptiveBackoff()
+    for (rule_name, rule_parameters), rule_events in events_by_rule.items():
+        items = {}
+        for latest in rule_events:
+            item = json.loads(latest['event']['invokingEvent'])[
+                'configurationItem']
+            items[item['resourceId']] = item
+        try:
+            compliance_types = evaluate_batch(json.loads(rule_parameters), items)
+        except Exception as e:
+            logger.error('Evaluating %s items of rule %s failed: %s',
+                         len(items), rule_name, e)
+            for latest in rule_events:
+                failed_message_ids.update(latest['message_ids'])
+            continue
+        for latest in rule_events:
+            resource_id = json.loads(latest['event']['invokingEvent'])[
+                'configurationItem']['resourceId']
+            try:
+                put_queued_evaluation(backoff, latest['event'],
+                                      compliance_types[resource_id])
+            except Exception as e:
+                logger.error('Putting the evaluation of %s failed: %s',
+                             resource_id, e)
+                failed_message_ids.update(latest['message_ids'])
+
+    logger.info('%s of %s queued events failed', len(failed_message_ids),
+                len(event['Records']))
+    dead_lettered = [
+        record['messageId'] for record in event['Records']
+        if record['messageId'] in failed_message_ids
+        and int(record.get('attributes', {}).get(
+            'ApproximateReceiveCount', 0)) >= QUEUE_MAX_RECEIVE_COUNT
+    ]
+    if dead_lettered:
+        logger.error('Events of messages %s failed %s times and go to the '
+                     'dead letter queue', ', '.join(dead_lettered),
+                     QUEUE_MAX_RECEIVE_COUNT)
+    return {'batchItemFailures': [
+        {'itemIdentifier': message_id}
+        for message_id in sorted(failed_message_ids)
+    ]}
+
+
+if PRIME_ON_INIT:
+    prime(PRIME_POLICIES)
@@ -1,20 +1,87 @@
 #!/usr/bin/env python
 
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
 import json
 import logging
 import os
+import shutil
+import signal
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.root.setLevel(logging.DEBUG)
 
 OPA_BINARY_PATH = os.environ["OPA_BINARY_PATH"]
-OPA_FILES_DIR = sys.argv[1]
-INPUT_FILES = sys.argv[2:]
-OPA_COMMAND_TEMPLATE = "{opa_binary_path} eval --format pretty -d {opa_policy_files_dir} -i {input_file_path} '{query}'"
-COMPLIANCE_CHECK_QUERY = '[ f | props := walk(data); props[0][count(props[0]) - 1] == "compliant"; f := {"package": concat(".", array.slice(props[0], 0, count(props[0]) - 1)), "compliant": props[1]}]'
+OPA_COMMAND_TEMPLATE = "{opa_binary_path} eval --format pretty {policy_args} -i {input_file_path} '{query}'"
+OPA_PROFILE_COMMAND_TEMPLATE = "{opa_binary_path} eval --format json --metrics --profile {policy_args} -i {input_file_path} '{query}'"
+OPA_BUILD_COMMAND_TEMPLATE = (
+    "{opa_binary_path} build {build_args} -o {bundle_file_path} {opa_policy_files_dir}"
+)
+OPA_PARSE_COMMAND_TEMPLATE = "{opa_binary_path} parse --format json {policy_file_path}"
+COMPLIANCE_RULE_NAME = "compliant"
+# A package that defines this rule declares that its compliance rule is the
+# conjunction of a check on each resource: it is compliant for a template if
+# and only if it is compliant for every resource alone, and compliant for a
+# template without resources. Such packages can be evaluated against only the
+# resources that changed since the last passing cloud assembly.
+RESOURCE_SCOPED_RULE_NAME = "resource_scoped"
+# The compliance query is built from the packages in the policy index that
+# define a COMPLIANCE_RULE_NAME rule. Each package gets its own comprehension,
+# so a rule that is undefined for an input only drops that package's result.
+PACKAGE_COMPLIANCE_QUERY_TEMPLATE = (
+    '{{ {{"package": {package}, "compliant": c}} | c := data{ref}.{rule} }}'
+)
+# In incremental mode, resource scoped packages are evaluated against the
+# template holding only the changed resources, when the input has one.
+RESOURCE_SCOPED_PACKAGE_COMPLIANCE_QUERY_TEMPLATE = '{{ {{"package": {package}, "compliant": c}} | changed := object.get(input, {changed_key}, input); c := data{ref}.{rule} with input as changed }}'
+COMPLIANCE_CHECK_QUERY_TEMPLATE = "union({{ {package_queries} }})"
+# Evaluates the compliance query against every template in a single OPA run.
+# The input document maps each input file path to its template, and the
+# compliance query is re-run with input bound to each template in turn.
+BATCH_COMPLIANCE_CHECK_QUERY_TEMPLATE = "{{ input_file: results | template := input[input_file]; results := {query} with input as template }}"
+INPUT_DOCUMENT_FILENAME = "input.json"
+# Every template is preprocessed once before evaluation with an index of the
+# logical IDs of its resources by resource type, added under this top-level
+# key. Policies can look up the resources of one type with
+# input.ResourceIdsByType[<type>] instead of scanning input.Resources.
+RESOURCE_IDS_BY_TYPE_KEY = "ResourceIdsByType"
+# In incremental mode, the template reduced to the resources added or modified
+# since the last passing cloud assembly is added under this top-level key.
+CHANGED_RESOURCES_TEMPLATE_KEY = "ChangedResourcesTemplate"
+BASELINE_POLICY_HASH_FILENAME = "POLICY_HASH"
+# The server's query API only returns variable bindings, so the query value is
+# bound to this variable.
+SERVER_QUERY_RESULT_VAR = "opa_eval_result"
+SERVER_QUERY_PATH = "/v1/query?metrics=true"
+SERVER_PROFILE_QUERY_PATH = "/v1/query?metrics=true&instrument=true"
+SERVER_HEALTH_PATH = "/health"
+SERVER_STARTUP_TIMEOUT_SECONDS = 30
+SERVER_SHUTDOWN_TIMEOUT_SECONDS = 10
+SERVER_REQUEST_TIMEOUT_SECONDS = 300
+# Files that OPA loads from a policy directory. Any change to one of them
+# changes the policy hash and forces the bundle to be rebuilt.
+POLICY_FILE_EXTENSIONS = (".rego", ".json", ".yaml", ".yml")
+# Bumped whenever the layout of the cache directory changes.
+CACHE_FORMAT_VERSION = "5"
+BUNDLE_CACHE_SUBDIR = "bundles"
+# Without a cache directory, the policy index is cached in the policy
+# directory under this name, which OPA doesn't load and the policy hash skips
+POLICY_INDEX_FILENAME = ".opa_eval_index"
+MAX_CACHED_BUNDLES = 5
+RESULT_CACHE_SUBDIR = "results"
+DEFAULT_RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_PROFILE_OUTPUT_FILE = "opa_eval_profile.json"
+DEFAULT_PROFILE_TOP = 10
+QUERY_EVAL_TIME_METRIC = "timer_rego_query_eval_ns"
 
 
 def run_process(command):
@@ -42,34 +109,1073 @@ def run_process(command):
         return output
 
 
-def main():
-    if INPUT_FILES:
-        logger.info("Received input files %s", INPUT_FILES)
+def run_command(command):
+    """Run a command that does not print JSON, exiting if it fails."""
+    process = subprocess.run(command, capture_output=True, shell=True, encoding="utf-8")
+    if process.returncode != 0:
+        logger.error(
+            "Command '%s' failed with exit code %s. stdout: '%s', stderr: '%s'",
+            command,
+            process.returncode,
+            process.stdout,
+            process.stderr,
+        )
+        sys.exit(2)
+    return process
+
+
+def iter_policy_files(opa_files_dir, extensions=POLICY_FILE_EXTENSIONS):
+    """Yield the policy files in the directory in a stable order."""
+    for root, dirs, files in os.walk(opa_files_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith(extensions):
+                yield os.path.join(root, filename)
+
+
+def hash_policy_dir(opa_files_dir):
+    """Return a hash of the path and content of every policy file in the directory."""
+    digest = hashlib.sha256(CACHE_FORMAT_VERSION.encode("utf-8"))
+    for policy_file in iter_policy_files(opa_files_dir):
+        with open(policy_file, "rb") as fp:
+            content_hash = hashlib.sha256(fp.read()).hexdigest()
+        digest.update(
+            "{}\0{}\0".format(
+                os.path.relpath(policy_file, opa_files_dir), content_hash
+            ).encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+def rule_name(rule):
+    """Return the name of a parsed rule. Rules with a ref head, like
+    `a.b := ...`, have no name in their head, only the ref starting with it."""
+    head = rule["head"]
+    return head.get("name") or head["ref"][0]["value"]
+
+
+def discover_compliance_packages(opa_files_dir):
+    """Return the index of the packages that define a compliance rule.
+
+    The index holds the path of every such package under "packages", and the
+    paths of those that are also resource scoped under
+    "resource_scoped_packages". Packages are found from the AST of each rego
+    file, so no policy is evaluated to discover them."""
+    rule_names_by_package = {}
+    for policy_file in iter_policy_files(opa_files_dir, (".rego",)):
+        module = run_process(
+            OPA_PARSE_COMMAND_TEMPLATE.format(
+                opa_binary_path=OPA_BINARY_PATH, policy_file_path=policy_file
+            )
+        )
+        # The first term of a package path is always `data`
+        package_path = tuple(term["value"] for term in module["package"]["path"][1:])
+        rule_names_by_package.setdefault(package_path, set()).update(
+            rule_name(rule) for rule in module.get("rules", [])
+        )
+    package_paths = sorted(
+        package_path
+        for package_path, rule_names in rule_names_by_package.items()
+        if COMPLIANCE_RULE_NAME in rule_names
+    )
+    return {
+        "packages": [list(package_path) for package_path in package_paths],
+        "resource_scoped_packages": [
+            list(package_path)
+            for package_path in package_paths
+            if RESOURCE_SCOPED_RULE_NAME in rule_names_by_package[package_path]
+        ],
+    }
+
+
+def get_policy_index(opa_files_dir, cache_dir, policy_hash):
+    """Return the index of the compliance packages of the policy directory.
+
+    The index is stored next to the policy bundle under the policy hash, or
+    without a cache directory in the policy directory itself, and only rebuilt
+    when a policy file changes."""
+    if cache_dir:
+        index_dir = os.path.join(cache_dir, BUNDLE_CACHE_SUBDIR)
+        os.makedirs(index_dir, exist_ok=True)
+        index_file = os.path.join(index_dir, "{}.index.json".format(policy_hash))
     else:
-        logger.warning("No input files received")
-    for input_file in INPUT_FILES:
-        command = OPA_COMMAND_TEMPLATE.format(
+        index_dir = opa_files_dir
+        index_file = os.path.join(opa_files_dir, POLICY_INDEX_FILENAME)
+    try:
+        with open(index_file, encoding="utf-8") as fp:
+            policy_index = json.load(fp)
+        if policy_index["policy_hash"] != policy_hash:
+            raise ValueError("Policy index is out of date")
+        policy_index["packages"], policy_index["resource_scoped_packages"]
+    except (OSError, ValueError, KeyError):
+        policy_index = discover_compliance_packages(opa_files_dir)
+        policy_index["policy_hash"] = policy_hash
+        try:
+            fd, tmp_index_file = tempfile.mkstemp(dir=index_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                json.dump(policy_index, fp)
+            os.replace(tmp_index_file, index_file)
+        except OSError as e:
+            # A read-only policy directory only costs rebuilding the index
+            logger.warning("Could not cache policy index in %s: %s", index_file, e)
+        else:
+            logger.info("Built policy index %s", index_file)
+    else:
+        logger.info("Using cached policy index %s", index_file)
+    return policy_index
+
+
+def build_compliance_check_query(package_paths, resource_scoped_package_paths=()):
+    """Build a query returning the compliance rule result of each package.
+
+    The packages in resource_scoped_package_paths are evaluated against the
+    changed resources of the input when it has them."""
+    package_queries = []
+    for package_path in package_paths:
+        query_template = (
+            RESOURCE_SCOPED_PACKAGE_COMPLIANCE_QUERY_TEMPLATE
+            if package_path in resource_scoped_package_paths
+            else PACKAGE_COMPLIANCE_QUERY_TEMPLATE
+        )
+        package_queries.append(
+            query_template.format(
+                package=json.dumps(".".join(package_path)),
+                ref="".join("[{}]".format(json.dumps(part)) for part in package_path),
+                rule=COMPLIANCE_RULE_NAME,
+                changed_key=json.dumps(CHANGED_RESOURCES_TEMPLATE_KEY),
+            )
+        )
+    if not package_queries:
+        logger.warning("No OPA policy defines a %s rule", COMPLIANCE_RULE_NAME)
+        return "[]"
+    return COMPLIANCE_CHECK_QUERY_TEMPLATE.format(
+        package_queries=", ".join(package_queries)
+    )
+
+
+def baseline_template_file(baseline_dir, input_file):
+    """Return the baseline copy of input_file, named after a hash of its path
+    relative to the working directory so input files with the same name in
+    different directories get their own copies."""
+    path_hash = hashlib.sha256(
+        os.path.relpath(os.path.abspath(input_file)).encode("utf-8")
+    ).hexdigest()[:16]
+    return os.path.join(
+        baseline_dir, "{}-{}".format(path_hash, os.path.basename(input_file))
+    )
+
+
+def get_baseline_dir(baseline_dir, policy_hash):
+    """Return baseline_dir if it holds a passing cloud assembly for these policies.
+
+    A baseline checked against other policies cannot vouch for the unchanged
+    resources, so it is ignored."""
+    try:
+        with open(
+            os.path.join(baseline_dir, BASELINE_POLICY_HASH_FILENAME), encoding="utf-8"
+        ) as fp:
+            baseline_policy_hash = fp.read().strip()
+    except OSError:
+        logger.info("No passing cloud assembly found in %s", baseline_dir)
+        return None
+    if baseline_policy_hash != policy_hash:
+        logger.info(
+            "The cloud assembly in %s was checked against other policies, ignoring it",
+            baseline_dir,
+        )
+        return None
+    return baseline_dir
+
+
+def find_unchanged_input_files(input_files, baseline_dir, package_paths):
+    """Return passing results for the input files identical to their baseline copy."""
+    results = {}
+    for input_file in input_files:
+        try:
+            with open(input_file, "rb") as fp, open(
+                baseline_template_file(baseline_dir, input_file), "rb"
+            ) as baseline_fp:
+                unchanged = fp.read() == baseline_fp.read()
+        except OSError:
+            continue
+        if unchanged:
+            logger.info(
+                "Input file %s is unchanged since the last passing cloud assembly",
+                input_file,
+            )
+            results[input_file] = [
+                {"package": ".".join(package_path), "compliant": True}
+                for package_path in package_paths
+            ]
+    return results
+
+
+def save_baseline(baseline_dir, input_files, policy_hash):
+    """Save the input files as the last passing cloud assembly."""
+    if os.path.isdir(baseline_dir):
+        shutil.rmtree(baseline_dir)
+    os.makedirs(baseline_dir)
+    for input_file in input_files:
+        shutil.copyfile(input_file, baseline_template_file(baseline_dir, input_file))
+    # Written last, so an interrupted save leaves no usable baseline
+    with open(
+        os.path.join(baseline_dir, BASELINE_POLICY_HASH_FILENAME), "w", encoding="utf-8"
+    ) as fp:
+        fp.write(policy_hash)
+    logger.info("Saved the passing cloud assembly to %s", baseline_dir)
+
+
+def prune_cached_bundles(bundle_dir):
+    """Keep only the MAX_CACHED_BUNDLES most recently used bundles and their indexes."""
+    bundles = sorted(
+        (
+            os.path.join(bundle_dir, filename)
+            for filename in os.listdir(bundle_dir)
+            if filename.endswith(".tar.gz")
+        ),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for bundle in bundles[MAX_CACHED_BUNDLES:]:
+        logger.debug("Removing stale policy bundle %s", bundle)
+        os.remove(bundle)
+        index_file = bundle[: -len(".tar.gz")] + ".index.json"
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+
+def get_policy_bundle(opa_files_dir, cache_dir, policy_hash, package_paths):
+    """Return the path to a compiled bundle of the policy directory.
+
+    Bundles are stored in the cache directory under the hash of the policy
+    directory, so the bundle is only rebuilt when a policy file changes. The
+    compliance rules of the given packages are used as entrypoints to build
+    an optimized bundle."""
+    bundle_dir = os.path.join(cache_dir, BUNDLE_CACHE_SUBDIR)
+    os.makedirs(bundle_dir, exist_ok=True)
+    bundle_file = os.path.join(bundle_dir, "{}.tar.gz".format(policy_hash))
+    if os.path.exists(bundle_file):
+        logger.info("Using cached policy bundle %s", bundle_file)
+        os.utime(bundle_file)
+        return bundle_file
+    # Build to a temporary file first so that concurrent runs sharing the
+    # cache never see a partially written bundle.
+    fd, tmp_bundle_file = tempfile.mkstemp(dir=bundle_dir, suffix=".tmp")
+    os.close(fd)
+    build_args = " ".join(
+        "-e {}".format("/".join(package_path + [COMPLIANCE_RULE_NAME]))
+        for package_path in package_paths
+    )
+    if build_args:
+        build_args = "-O=1 " + build_args
+    try:
+        run_command(
+            OPA_BUILD_COMMAND_TEMPLATE.format(
+                opa_binary_path=OPA_BINARY_PATH,
+                build_args=build_args,
+                bundle_file_path=tmp_bundle_file,
+                opa_policy_files_dir=opa_files_dir,
+            )
+        )
+        os.replace(tmp_bundle_file, bundle_file)
+    finally:
+        if os.path.exists(tmp_bundle_file):
+            os.remove(tmp_bundle_file)
+    logger.info("Built policy bundle %s", bundle_file)
+    prune_cached_bundles(bundle_dir)
+    return bundle_file
+
+
+class ResultCache(object):
+    """Content-addressed cache of compliance results for input files.
+
+    Entries are keyed by the policy hash, the hash of the input file content
+    and the compliance query, so a template is only re-evaluated when it, the
+    policies or the query change. The cache is bounded to max_bytes on disk by
+    evicting the least recently used entries."""
+
+    def __init__(self, cache_dir, policy_hash, query, max_bytes) -> None:
+        self.results_dir = os.path.join(cache_dir, RESULT_CACHE_SUBDIR)
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.policy_hash = policy_hash
+        self.query = query
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entry_files = {}
+
+    def _entry_file(self, input_file):
+        if input_file not in self._entry_files:
+            with open(input_file, "rb") as fp:
+                template_hash = hashlib.sha256(fp.read()).hexdigest()
+            key = hashlib.sha256(
+                "{}\0{}\0{}".format(self.policy_hash, template_hash, self.query).encode(
+                    "utf-8"
+                )
+            ).hexdigest()
+            self._entry_files[input_file] = os.path.join(
+                self.results_dir, "{}.json".format(key)
+            )
+        return self._entry_files[input_file]
+
+    def get(self, input_file):
+        """Return the cached results for the input file, or None on a miss."""
+        entry_file = self._entry_file(input_file)
+        try:
+            with open(entry_file, encoding="utf-8") as fp:
+                opa_result = json.load(fp)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(entry_file)
+        self.hits += 1
+        logger.debug("Result cache hit for input file %s", input_file)
+        return opa_result
+
+    def get_many(self, input_files):
+        """Return a dict of input file to cached results for every hit."""
+        results = {}
+        for input_file in input_files:
+            opa_result = self.get(input_file)
+            if opa_result is not None:
+                results[input_file] = opa_result
+        return results
+
+    def put(self, input_file, opa_result):
+        entry_file = self._entry_file(input_file)
+        fd, tmp_entry_file = tempfile.mkstemp(dir=self.results_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            json.dump(opa_result, fp)
+        os.replace(tmp_entry_file, entry_file)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total_bytes = 0
+        for filename in os.listdir(self.results_dir):
+            if not filename.endswith(".json"):
+                continue
+            entry_file = os.path.join(self.results_dir, filename)
+            stat = os.stat(entry_file)
+            entries.append((stat.st_mtime, stat.st_size, entry_file))
+            total_bytes += stat.st_size
+        for _, size, entry_file in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(entry_file)
+            total_bytes -= size
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        logger.info(
+            "Result cache: %s hits, %s misses (%.0f%% hit rate)",
+            self.hits,
+            self.misses,
+            100.0 * self.hits / lookups if lookups else 0.0,
+        )
+
+
+class OpaEvalBackend(object):
+    """Evaluates queries by running `opa eval` once per query.
+
+    With profile set, OPA's metrics and rule-level profile are recorded for
+    every query."""
+
+    def __init__(self, policy_args, profile=False) -> None:
+        self.policy_args = policy_args
+        self.profile = profile
+        self.query_metrics = []
+
+    def query_file(self, query, input_file, label=None):
+        command_template = (
+            OPA_PROFILE_COMMAND_TEMPLATE if self.profile else OPA_COMMAND_TEMPLATE
+        )
+        command = command_template.format(
             opa_binary_path=OPA_BINARY_PATH,
-            opa_policy_files_dir=OPA_FILES_DIR,
+            policy_args=self.policy_args,
             input_file_path=input_file,
-            query=COMPLIANCE_CHECK_QUERY,
+            query=query,
         )
-        opa_result = run_process(command)
-        for compliance_result in opa_result:
-            if compliance_result["compliant"]:
-                logger.info(
-                    "OPA policy %s succeeded on input file %s",
-                    compliance_result["package"],
-                    input_file,
+        output = run_process(command)
+        if not self.profile:
+            return output
+        self.query_metrics.append(
+            {
+                "label": label or input_file,
+                "metrics": output.get("metrics", {}),
+                "profile": output.get("profile", []),
+            }
+        )
+        try:
+            return output["result"][0]["expressions"][0]["value"]
+        except (KeyError, IndexError):
+            logger.error("OPA returned no result for %s", label or input_file)
+            sys.exit(2)
+
+    def query_document(self, query, input_document, label=None):
+        with tempfile.TemporaryDirectory() as input_dir:
+            input_file = os.path.join(input_dir, INPUT_DOCUMENT_FILENAME)
+            with open(input_file, "w", encoding="utf-8") as fp:
+                json.dump(input_document, fp)
+            return self.query_file(query, input_file, label)
+
+    def pop_query_metrics(self):
+        query_metrics, self.query_metrics = self.query_metrics, []
+        return query_metrics
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class OpaServer(object):
+    """Runs `opa run --server` on localhost with the policies loaded for the
+    duration of a with block."""
+
+    def __init__(self, policy_path, bundle=False) -> None:
+        self.policy_path = policy_path
+        self.bundle = bundle
+        self.address = None
+        self.process = None
+
+    def __enter__(self):
+        self.address = "localhost:{}".format(find_free_port())
+        command = [
+            OPA_BINARY_PATH,
+            "run",
+            "--server",
+            "--addr",
+            self.address,
+            "--log-level",
+            "error",
+        ]
+        if self.bundle:
+            command.append("--bundle")
+        command.append(self.policy_path)
+        logger.info("Starting OPA server on %s", self.address)
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        try:
+            self.wait_until_healthy()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def wait_until_healthy(self):
+        deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                logger.error(
+                    "OPA server exited with code %s during startup",
+                    self.process.returncode,
+                )
+                sys.exit(2)
+            connection = http.client.HTTPConnection(self.address, timeout=1)
+            try:
+                connection.request("GET", SERVER_HEALTH_PATH)
+                if connection.getresponse().status == 200:
+                    logger.info("OPA server is ready")
+                    return
+            except (http.client.HTTPException, OSError):
+                pass
+            finally:
+                connection.close()
+            time.sleep(0.05)
+        logger.error(
+            "OPA server did not become healthy within %s seconds",
+            SERVER_STARTUP_TIMEOUT_SECONDS,
+        )
+        sys.exit(2)
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=SERVER_SHUTDOWN_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            logger.warning("OPA server did not shut down cleanly, killing it")
+            self.process.kill()
+            self.process.wait()
+        logger.info("OPA server stopped")
+
+
+class OpaServerBackend(object):
+    """Evaluates queries by POSTing them to a running OPA server.
+
+    Each process keeps a single persistent HTTP connection to the server and
+    records the metrics OPA returns for every query. With profile set, the
+    server is also asked for its more detailed instrumentation metrics. The
+    server API does not return a rule-level profile."""
+
+    def __init__(self, address, profile=False) -> None:
+        self.address = address
+        self.profile = profile
+        self.query_metrics = []
+        self._connection = None
+
+    def __getstate__(self):
+        # Connections are not shared between worker processes
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        return state
+
+    def _post(self, body):
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(
+                    self.address, timeout=SERVER_REQUEST_TIMEOUT_SECONDS
+                )
+            try:
+                self._connection.request(
+                    "POST",
+                    SERVER_PROFILE_QUERY_PATH if self.profile else SERVER_QUERY_PATH,
+                    body=body.encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
                 )
-            else:
+                response = self._connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle keep-alive connection
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
                 logger.error(
-                    "OPA policy %s failed on input file %s",
-                    compliance_result["package"],
-                    input_file,
+                    "OPA server query failed with status %s: %s",
+                    response.status,
+                    payload.decode("utf-8", "replace"),
                 )
-                sys.exit(1)
-        logger.info("All OPA policy checks succeeded")
+                sys.exit(2)
+            return json.loads(payload)
+
+    def _query(self, body, label):
+        output = self._post(body)
+        logger.debug("OPA server response: %s", output)
+        self.query_metrics.append(
+            {"label": label, "metrics": output.get("metrics", {})}
+        )
+        try:
+            return output["result"][0][SERVER_QUERY_RESULT_VAR]
+        except (KeyError, IndexError):
+            logger.error("OPA server returned no result for %s", label)
+            sys.exit(2)
+
+    def _server_query(self, query):
+        return json.dumps("{} := {}".format(SERVER_QUERY_RESULT_VAR, query))
+
+    def query_document(self, query, input_document, label=None):
+        body = '{{"query": {}, "input": {}}}'.format(
+            self._server_query(query), json.dumps(input_document)
+        )
+        return self._query(body, label or INPUT_DOCUMENT_FILENAME)
+
+    def pop_query_metrics(self):
+        query_metrics, self.query_metrics = self.query_metrics, []
+        return query_metrics
+
+
+def log_query_metrics(query_metrics):
+    """Log the totals of the metrics OPA reported across all queries."""
+    totals = {}
+    for record in query_metrics:
+        for name, value in record["metrics"].items():
+            totals[name] = totals.get(name, 0) + value
+    logger.info(
+        "OPA metrics totalled over %s queries: %s",
+        len(query_metrics),
+        json.dumps(totals, sort_keys=True),
+    )
+
+
+def summarize_profile(query_metrics):
+    """Aggregate the recorded metrics and profiles by query and by rule.
+
+    Each query is labelled with the input file it evaluated (or the batch it
+    belongs to). Rule profiles are summed by source location, and those sums
+    are summed again by policy file."""
+    queries = []
+    rules = {}
+    policies = {}
+    for record in query_metrics:
+        queries.append(
+            {
+                "label": record["label"],
+                "eval_time_ns": record["metrics"].get(QUERY_EVAL_TIME_METRIC, 0),
+                "metrics": record["metrics"],
+            }
+        )
+        for entry in record.get("profile", []):
+            location = entry.get("location", {})
+            key = "{}:{}".format(location.get("file", "?"), location.get("row", "?"))
+            for summary, summary_key in (
+                (rules, key),
+                (policies, location.get("file", "?")),
+            ):
+                totals = summary.setdefault(
+                    summary_key,
+                    {"location": summary_key, "total_time_ns": 0, "num_eval": 0},
+                )
+                totals["total_time_ns"] += entry.get("total_time_ns", 0)
+                totals["num_eval"] += entry.get("num_eval", 0)
+    return {
+        "queries": sorted(queries, key=lambda q: q["eval_time_ns"], reverse=True),
+        "rules": sorted(rules.values(), key=lambda r: r["total_time_ns"], reverse=True),
+        "policies": sorted(
+            policies.values(), key=lambda p: p["total_time_ns"], reverse=True
+        ),
+    }
+
+
+def report_profile(query_metrics, output_file, top):
+    """Log the top entries of the profile and write all of it to output_file."""
+    summary = summarize_profile(query_metrics)
+    logger.info("Slowest %s OPA queries by eval time:", top)
+    for query in summary["queries"][:top]:
+        logger.info("  %12d ns  %s", query["eval_time_ns"], query["label"])
+    if summary["rules"]:
+        logger.info("Slowest %s rule locations by total time:", top)
+        for rule in summary["rules"][:top]:
+            logger.info(
+                "  %12d ns  %8d evals  %s",
+                rule["total_time_ns"],
+                rule["num_eval"],
+                rule["location"],
+            )
+        logger.info("Top %s rule locations by number of evaluations:", top)
+        for rule in sorted(summary["rules"], key=lambda r: r["num_eval"], reverse=True)[
+            :top
+        ]:
+            logger.info(
+                "  %8d evals  %12d ns  %s",
+                rule["num_eval"],
+                rule["total_time_ns"],
+                rule["location"],
+            )
+        logger.info("OPA policy files by total time:")
+        for policy in summary["policies"][:top]:
+            logger.info(
+                "  %12d ns  %8d evals  %s",
+                policy["total_time_ns"],
+                policy["num_eval"],
+                policy["location"],
+            )
+    else:
+        logger.info("No rule-level profile was recorded")
+    with open(output_file, "w", encoding="utf-8") as fp:
+        json.dump(summary, fp, indent=2)
+    logger.info("Wrote OPA profile to %s", output_file)
+
+
+def read_template(template_file):
+    with open(template_file, encoding="utf-8") as fp:
+        try:
+            return json.load(fp)
+        except json.decoder.JSONDecodeError as e:
+            logger.error(
+                "Could not decode JSON from input file %s: %s", template_file, e
+            )
+            sys.exit(2)
+
+
+def index_template(template):
+    """Add the index of the template's resources by type to the template."""
+    resource_ids_by_type = {}
+    for logical_id, resource in template.get("Resources", {}).items():
+        resource_ids_by_type.setdefault(resource.get("Type"), []).append(logical_id)
+    template[RESOURCE_IDS_BY_TYPE_KEY] = resource_ids_by_type
+    return template
+
+
+def changed_resources_template(template, baseline_template):
+    """Return the template with only the resources added or modified since the baseline."""
+    baseline_resources = baseline_template.get("Resources", {})
+    changed_template = dict(template)
+    changed_template["Resources"] = {
+        logical_id: resource
+        for logical_id, resource in template.get("Resources", {}).items()
+        if baseline_resources.get(logical_id) != resource
+    }
+    return index_template(changed_template)
+
+
+def load_input_file(input_file, baseline_dir=None):
+    """Load a template and add the index of its resources by type.
+
+    The original keys of the template are left unchanged. When the template
+    has a copy in the baseline directory, the template reduced to its changed
+    resources is added as well."""
+    template = read_template(input_file)
+    changed_template = None
+    if baseline_dir:
+        baseline_file = baseline_template_file(baseline_dir, input_file)
+        if os.path.exists(baseline_file):
+            changed_template = changed_resources_template(
+                template, read_template(baseline_file)
+            )
+            logger.debug(
+                "Input file %s has %s changed resources",
+                input_file,
+                len(changed_template["Resources"]),
+            )
+    index_template(template)
+    if changed_template is not None:
+        template[CHANGED_RESOURCES_TEMPLATE_KEY] = changed_template
+    return template
+
+
+def evaluate_input_file(backend, query, input_file, baseline_dir=None):
+    """Run the compliance query against a single template and return its results."""
+    return backend.query_document(
+        query, load_input_file(input_file, baseline_dir), label=input_file
+    )
+
+
+def evaluate_input_files_batch(backend, query, input_files, baseline_dir=None):
+    """Run the compliance query against every template in one OPA query.
+
+    Policies are loaded and compiled once for the whole batch. Returns a dict
+    mapping each input file to its compliance results."""
+    batch_input = {
+        input_file: load_input_file(input_file, baseline_dir)
+        for input_file in input_files
+    }
+    return backend.query_document(
+        BATCH_COMPLIANCE_CHECK_QUERY_TEMPLATE.format(query=query),
+        batch_input,
+        label="batch of {} input files".format(len(input_files)),
+    )
+
+
+def evaluate_work_unit(backend, query, input_files, batch, baseline_dir=None):
+    """Evaluate a group of input files in a worker process.
+
+    Returns a dict of file to compliance results and the OPA metrics recorded
+    while evaluating them."""
+    if batch:
+        unit_results = evaluate_input_files_batch(
+            backend, query, input_files, baseline_dir
+        )
+    else:
+        unit_results = {
+            input_file: evaluate_input_file(backend, query, input_file, baseline_dir)
+            for input_file in input_files
+        }
+    return unit_results, backend.pop_query_metrics()
+
+
+def split_work_units(input_files, jobs, batch):
+    """Split the input files into work units for the process pool.
+
+    Without batching every file is its own unit. With batching the files are
+    split into at most `jobs` contiguous batches so each worker runs OPA once."""
+    if not batch:
+        return [[input_file] for input_file in input_files]
+    batch_size = -(-len(input_files) // jobs)
+    return [
+        input_files[i : i + batch_size] for i in range(0, len(input_files), batch_size)
+    ]
+
+
+def is_compliant(opa_result):
+    return all(compliance_result["compliant"] for compliance_result in opa_result)
+
+
+def check_results(input_file, opa_result):
+    """Log the result of each OPA policy for the input file, stopping at the first failure.
+
+    Returns False if any policy failed."""
+    for compliance_result in opa_result:
+        if compliance_result["compliant"]:
+            logger.info(
+                "OPA policy %s succeeded on input file %s",
+                compliance_result["package"],
+                input_file,
+            )
+        else:
+            logger.error(
+                "OPA policy %s failed on input file %s",
+                compliance_result["package"],
+                input_file,
+            )
+            return False
+    return True
+
+
+def start_worker_process_group():
+    """Run the worker in a process group of its own, with the OPA processes it
+    starts, so they can be killed together."""
+    os.setpgrp()
+
+
+def kill_workers(executor):
+    # The pool's processes aren't exposed by ProcessPoolExecutor
+    for pid in list(executor._processes or {}):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def evaluate_in_parallel(backend, query, input_files, jobs, batch, baseline_dir=None):
+    """Evaluate the input files on a pool of `jobs` worker processes.
+
+    Returns a dict of file to compliance results and the list of failing files.
+    The OPA metrics recorded by the workers are added to the backend's.
+    As soon as any worker confirms a failing template, the work that has not
+    started yet is cancelled, the workers still evaluating are killed with
+    their OPA processes, and only the results of the failing unit are
+    returned."""
+    work_units = split_work_units(input_files, jobs, batch)
+    results = {}
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=start_worker_process_group
+    )
+    futures = [
+        executor.submit(
+            evaluate_work_unit, backend, query, work_unit, batch, baseline_dir
+        )
+        for work_unit in work_units
+    ]
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            unit_results, query_metrics = future.result()
+            backend.query_metrics.extend(query_metrics)
+            failed_files = [
+                input_file
+                for input_file, opa_result in unit_results.items()
+                if not is_compliant(opa_result)
+            ]
+            if failed_files:
+                logger.info(
+                    "Stopping outstanding evaluations after failure on %s",
+                    failed_files,
+                )
+                return unit_results, failed_files
+            results.update(unit_results)
+    finally:
+        for future in futures:
+            future.cancel()
+        # Work units that already started can't be cancelled
+        if not all(future.done() for future in futures):
+            kill_workers(executor)
+        executor.shutdown(wait=True)
+    return results, []
+
+
+def check_input_files(
+    backend,
+    query,
+    input_files,
+    jobs,
+    batch,
+    result_cache=None,
+    baseline_dir=None,
+    known_results=None,
+):
+    """Evaluate every input file and log its results in input file order.
+
+    Input files in known_results or with a known verdict in the result cache
+    are not evaluated again. With a baseline directory, input files are
+    evaluated incrementally against their copy in it. Returns False as soon as
+    a failing input file is reported."""
+    results = dict(known_results or {})
+    if result_cache:
+        results.update(
+            result_cache.get_many(
+                [input_file for input_file in input_files if input_file not in results]
+            )
+        )
+    pending_files = [
+        input_file for input_file in input_files if input_file not in results
+    ]
+    if not all(is_compliant(opa_result) for opa_result in results.values()):
+        # A cached failure already fails the run
+        pending_files = []
+    new_results = {}
+    failed_files = []
+    if pending_files and jobs > 1:
+        new_results, failed_files = evaluate_in_parallel(
+            backend, query, pending_files, jobs, batch, baseline_dir
+        )
+    elif pending_files and batch:
+        new_results = evaluate_input_files_batch(
+            backend, query, pending_files, baseline_dir
+        )
+    evaluate_sequentially = jobs == 1 and not batch
+    for input_file in input_files:
+        if input_file in new_results:
+            opa_result = new_results[input_file]
+        elif input_file in results:
+            opa_result = results[input_file]
+        elif evaluate_sequentially and pending_files:
+            opa_result = new_results[input_file] = evaluate_input_file(
+                backend, query, input_file, baseline_dir
+            )
+        else:
+            continue
+        if not check_results(input_file, opa_result):
+            break
+    if result_cache:
+        for input_file, opa_result in new_results.items():
+            result_cache.put(input_file, opa_result)
+    return not failed_files and all(
+        is_compliant(opa_result)
+        for opa_result in list(results.values()) + list(new_results.values())
+    )
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Evaluate CloudFormation templates against a directory of OPA policies."
+    )
+    parser.add_argument("opa_files_dir", help="Directory containing the rego policies")
+    parser.add_argument(
+        "input_files", nargs="*", help="CloudFormation template files to evaluate"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Evaluate all input files in a single OPA invocation instead of one per file",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help="Number of worker processes to evaluate input files with. "
+        "Combined with --batch, the input files are split into one batch per worker",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory to cache compiled policy bundles in across runs. "
+        "When set, policies are loaded from a bundle instead of the raw rego files "
+        "and the results of unchanged input files are reused",
+    )
+    parser.add_argument(
+        "--result-cache-max-bytes",
+        type=positive_int,
+        default=DEFAULT_RESULT_CACHE_MAX_BYTES,
+        help="Maximum size of the result cache in --cache-dir",
+    )
+    parser.add_argument(
+        "--baseline-dir",
+        help="Directory holding the last cloud assembly that passed the check. "
+        "Input files identical to their copy in it are not evaluated, and "
+        "resource scoped policies are only evaluated against the resources "
+        "added or modified since. The directory is replaced with the input "
+        "files when they all pass",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record OPA's metrics and rule-level profile for every query and report "
+        "the most expensive queries and rules. Run without --batch to profile each "
+        "input file separately. The rule-level profile needs the eval backend",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=DEFAULT_PROFILE_OUTPUT_FILE,
+        help="File to write the --profile data to as JSON",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=positive_int,
+        default=DEFAULT_PROFILE_TOP,
+        help="Number of entries to log in each --profile report",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("eval", "server"),
+        default="eval",
+        help="'eval' runs `opa eval` per query. 'server' starts one local OPA server "
+        "with the policies loaded and sends every query to it over HTTP",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.input_files:
+        logger.info("Received input files %s", args.input_files)
+    else:
+        logger.warning("No input files received")
+        return
+    policy_hash = hash_policy_dir(args.opa_files_dir)
+    policy_index = get_policy_index(args.opa_files_dir, args.cache_dir, policy_hash)
+    package_paths = policy_index["packages"]
+    baseline_dir = None
+    known_results = {}
+    if args.baseline_dir:
+        baseline_dir = get_baseline_dir(args.baseline_dir, policy_hash)
+    if baseline_dir:
+        query = build_compliance_check_query(
+            package_paths, policy_index["resource_scoped_packages"]
+        )
+        known_results = find_unchanged_input_files(
+            args.input_files, baseline_dir, package_paths
+        )
+    else:
+        query = build_compliance_check_query(package_paths)
+    result_cache = None
+    if args.cache_dir:
+        policy_path = get_policy_bundle(
+            args.opa_files_dir, args.cache_dir, policy_hash, package_paths
+        )
+        bundle = True
+        result_cache = ResultCache(
+            args.cache_dir, policy_hash, query, args.result_cache_max_bytes
+        )
+    else:
+        policy_path = args.opa_files_dir
+        bundle = False
+    with contextlib.ExitStack() as stack:
+        if args.backend == "server":
+            server = stack.enter_context(OpaServer(policy_path, bundle=bundle))
+            backend = OpaServerBackend(server.address, profile=args.profile)
+        else:
+            backend = OpaEvalBackend(
+                "{} {}".format("-b" if bundle else "-d", policy_path),
+                profile=args.profile,
+            )
+        try:
+            passed = check_input_files(
+                backend,
+                query,
+                args.input_files,
+                args.jobs,
+                args.batch,
+                result_cache,
+                baseline_dir,
+                known_results,
+            )
+        finally:
+            query_metrics = backend.pop_query_metrics()
+            if query_metrics:
+                log_query_metrics(query_metrics)
+            if args.profile:
+                report_profile(query_metrics, args.profile_output, args.profile_top)
+            if result_cache:
+                result_cache.log_stats()
+                result_cache.evict()
+    if not passed:
+        sys.exit(1)
+    logger.info("All OPA policy checks succeeded")
+    if args.baseline_dir:
+        save_baseline(args.baseline_dir, args.input_files, policy_hash)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.root.setLevel(logging.INFO)
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+OPA_EVAL_SCRIPT_PATH = os.path.join(CURRENT_DIR, "opa_eval.py")
+DEFAULT_OPA_POLICIES_DIR = os.path.join(CURRENT_DIR, "cfn_template_opa_policies")
+DEFAULT_OUTPUT_FILE = "opa_eval_benchmark.json"
+# Execution modes of opa_eval.py to benchmark, as extra command line arguments.
+# "{jobs}" is replaced with the --jobs value of the benchmark and "{cache_dir}"
+# with a cache directory that is kept between the repeats of that mode, so the
+# first repeat measures a cold cache and the rest a warm one.
+EXECUTION_MODES = {
+    "sequential": [],
+    "batch": ["--batch"],
+    "parallel": ["--jobs", "{jobs}"],
+    "parallel-batch": ["--batch", "--jobs", "{jobs}"],
+    "server": ["--backend", "server"],
+    "server-parallel": ["--backend", "server", "--jobs", "{jobs}"],
+    "cached": ["--batch", "--cache-dir", "{cache_dir}"],
+}
+FILLER_RESOURCE = {"Type": "AWS::SNS::Topic", "Properties": {}}
+
+
+def generate_bucket(encrypted):
+    bucket = {"Type": "AWS::S3::Bucket", "Properties": {}}
+    if encrypted:
+        bucket["Properties"]["BucketEncryption"] = {
+            "ServerSideEncryptionConfiguration": [
+                {"ServerSideEncryptionByDefault": {"SSEAlgorithm": "aws:kms"}}
+            ]
+        }
+    return bucket
+
+
+def generate_template(resources, bucket_ratio, encrypted_ratio, compliant=True):
+    """Generate a CloudFormation template with the given number of resources.
+
+    bucket_ratio of the resources are S3 buckets and encrypted_ratio of those
+    buckets are encrypted. The first bucket is always encrypted so the
+    template passes the S3 encryption policy, which needs at least one. If not
+    compliant, the template has at least one bucket and none are encrypted,
+    so it fails the policy."""
+    template_resources = {}
+    buckets = int(resources * bucket_ratio)
+    if compliant:
+        encrypted_buckets = max(1, int(buckets * encrypted_ratio)) if buckets else 0
+    else:
+        buckets = max(1, buckets)
+        encrypted_buckets = 0
+    for i in range(resources):
+        if i < buckets:
+            resource = generate_bucket(encrypted=i < encrypted_buckets)
+        else:
+            resource = FILLER_RESOURCE
+        template_resources["Resource{}".format(i)] = resource
+    return {"Resources": template_resources}
+
+
+def generate_cloud_assembly(
+    assembly_dir, stacks, resources, bucket_ratio, encrypted_ratio, failing_ratio
+):
+    """Write a synthetic cdk.out directory and return its template files.
+
+    The last failing_ratio of the templates fail the S3 encryption policy, so
+    the passing templates before them are evaluated before the failure stops
+    opa_eval.py."""
+    template_files = []
+    passing_stacks = stacks - int(stacks * failing_ratio)
+    for i in range(stacks):
+        template_file = os.path.join(assembly_dir, "Stack{}.template.json".format(i))
+        template = generate_template(
+            resources, bucket_ratio, encrypted_ratio, compliant=i < passing_stacks
+        )
+        with open(template_file, "w", encoding="utf-8") as fp:
+            json.dump(template, fp)
+        template_files.append(template_file)
+    return template_files
+
+
+def run_opa_eval(opa_files_dir, template_files, extra_args):
+    """Run opa_eval.py once and return its wall time, peak RSS and exit code.
+
+    The peak RSS is the largest resident set size in KiB of opa_eval.py and
+    of every OPA process it waited on."""
+    command = (
+        [sys.executable, OPA_EVAL_SCRIPT_PATH]
+        + extra_args
+        + [opa_files_dir]
+        + template_files
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    # The process was reaped by wait4, so Popen must not wait on it again
+    process.returncode = (
+        os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    )
+    return wall_seconds, rusage.ru_maxrss, process.returncode
+
+
+def benchmark_mode(
+    name, mode, opa_files_dir, template_files, jobs, repeat, expected_exit_code
+):
+    """Benchmark a mode of opa_eval.py on the template files, failing the
+    benchmark if opa_eval.py doesn't exit with expected_exit_code.
+
+    opa_eval.py stops at the first failing template, so the templates per
+    second are only reported for cloud assemblies that pass."""
+    cache_dir = tempfile.mkdtemp(prefix="opa-eval-benchmark-cache-")
+    extra_args = [
+        arg.format(jobs=jobs, cache_dir=cache_dir) for arg in EXECUTION_MODES[mode]
+    ]
+    runs = []
+    try:
+        for _ in range(repeat):
+            wall_seconds, peak_rss_kib, exit_code = run_opa_eval(
+                opa_files_dir, template_files, extra_args
+            )
+            # opa_eval.py exits with 1 when templates fail the policies
+            if exit_code != expected_exit_code:
+                logger.error(
+                    "%s: opa_eval.py exited with %s instead of %s",
+                    name,
+                    exit_code,
+                    expected_exit_code,
+                )
+                sys.exit(2)
+            runs.append(
+                {
+                    "wall_seconds": wall_seconds,
+                    "peak_rss_kib": peak_rss_kib,
+                    "exit_code": exit_code,
+                }
+            )
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    wall_times = [run["wall_seconds"] for run in runs]
+    median_wall_seconds = statistics.median(wall_times)
+    result = {
+        "mode": name,
+        "args": EXECUTION_MODES[mode],
+        "min_wall_seconds": min(wall_times),
+        "median_wall_seconds": median_wall_seconds,
+        "templates_per_second": (
+            None if expected_exit_code else len(template_files) / median_wall_seconds
+        ),
+        "peak_rss_kib": max(run["peak_rss_kib"] for run in runs),
+        "runs": runs,
+    }
+    logger.info(
+        "%s: median %.3fs, %s templates/s, peak RSS %s KiB",
+        name,
+        result["median_wall_seconds"],
+        (
+            "-"
+            if result["templates_per_second"] is None
+            else "{:.1f}".format(result["templates_per_second"])
+        ),
+        result["peak_rss_kib"],
+    )
+    return result
+
+
+def find_regressions(results, baseline_file, max_regression):
+    """Return the modes whose median wall time regressed past max_regression."""
+    with open(baseline_file, encoding="utf-8") as fp:
+        baseline = {result["mode"]: result for result in json.load(fp)["results"]}
+    regressions = []
+    for result in results:
+        if result["mode"] not in baseline:
+            continue
+        baseline_seconds = baseline[result["mode"]]["median_wall_seconds"]
+        change = result["median_wall_seconds"] / baseline_seconds - 1
+        if change > max_regression:
+            logger.error(
+                "%s: median wall time regressed by %.0f%% (%.3fs -> %.3fs)",
+                result["mode"],
+                change * 100,
+                baseline_seconds,
+                result["median_wall_seconds"],
+            )
+            regressions.append(result["mode"])
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark opa_eval.py against a synthetic cloud assembly."
+    )
+    parser.add_argument(
+        "--opa-files-dir",
+        default=DEFAULT_OPA_POLICIES_DIR,
+        help="Directory containing the rego policies",
+    )
+    parser.add_argument("--stacks", type=int, default=20, help="Number of templates")
+    parser.add_argument(
+        "--resources", type=int, default=200, help="Number of resources per template"
+    )
+    parser.add_argument(
+        "--bucket-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of the resources that are S3 buckets",
+    )
+    parser.add_argument(
+        "--encrypted-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of the S3 buckets that are encrypted",
+    )
+    parser.add_argument(
+        "--failing-ratio",
+        type=float,
+        default=0.25,
+        help="Fraction of the templates without encrypted buckets in the cloud "
+        "assembly of the <mode>-failing modes, 0 to only benchmark passing ones",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=sorted(EXECUTION_MODES),
+        default=list(EXECUTION_MODES),
+        help="Execution modes of opa_eval.py to benchmark",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="--jobs value for the parallel modes",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs of each mode"
+    )
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT_FILE,
+        help="File to write the benchmark results to as JSON",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Results file of a previous benchmark to compare median wall times with",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="Fraction by which a mode may be slower than the baseline before failing",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if "OPA_BINARY_PATH" not in os.environ:
+        logger.error("OPA_BINARY_PATH must be set to the OPA binary to benchmark")
+        sys.exit(2)
+    # Passing and failing cloud assemblies are benchmarked as separate modes,
+    # since opa_eval.py stops at the first failure
+    failing_ratios = {"": 0}
+    if int(args.stacks * args.failing_ratio):
+        failing_ratios["-failing"] = args.failing_ratio
+    results = []
+    for suffix, failing_ratio in failing_ratios.items():
+        assembly_dir = tempfile.mkdtemp(prefix="opa-eval-benchmark-cdk.out-")
+        try:
+            template_files = generate_cloud_assembly(
+                assembly_dir,
+                args.stacks,
+                args.resources,
+                args.bucket_ratio,
+                args.encrypted_ratio,
+                failing_ratio,
+            )
+            logger.info(
+                "Generated %s templates with %s resources each, %s of them failing, in %s",
+                args.stacks,
+                args.resources,
+                int(args.stacks * failing_ratio),
+                assembly_dir,
+            )
+            results.extend(
+                benchmark_mode(
+                    mode + suffix,
+                    mode,
+                    args.opa_files_dir,
+                    template_files,
+                    args.jobs,
+                    args.repeat,
+                    1 if failing_ratio else 0,
+                )
+                for mode in args.modes
+            )
+        finally:
+            shutil.rmtree(assembly_dir, ignore_errors=True)
+    with open(args.output, "w", encoding="utf-8") as fp:
+        json.dump(
+            {
+                "parameters": {
+                    "stacks": args.stacks,
+                    "resources": args.resources,
+                    "bucket_ratio": args.bucket_ratio,
+                    "encrypted_ratio": args.encrypted_ratio,
+                    "failing_ratio": args.failing_ratio,
+                    "jobs": args.jobs,
+                    "repeat": args.repeat,
+                    "opa_binary_path": os.environ["OPA_BINARY_PATH"],
+                },
+                "results": results,
+            },
+            fp,
+            indent=2,
+        )
+    logger.info("Wrote benchmark results to %s", args.output)
+    if args.baseline and find_regressions(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import boto3
 from aws_cdk import (
     core as cdk,
     aws_codepipeline as codepipeline,
@@ -8,6 +7,8 @@ from aws_cdk import (
     pipelines as pipelines,
 )
 
+from synth_lookups import SynthLookups, secret_string_lookup
+
 
 class PipelineMixin:
     """Add to a stack class and call configure_pipeline inside its constructor to make a self-mutating pipeline out of it.
@@ -32,10 +33,12 @@ class PipelineMixin:
             else None
         )
         if self.codestar_connection_arn_secret_id:
-            secrets_client = boto3.client("secretsmanager")
-            self.codestar_connection_arn = secrets_client.get_secret_value(
-                SecretId=self.codestar_connection_arn_secret_id
-            )["SecretString"]
+            synth_lookups = getattr(self, "synth_lookups", None) or SynthLookups(self)
+            self.codestar_connection_arn = synth_lookups.get(
+                f"secret/{self.codestar_connection_arn_secret_id}",
+                secret_string_lookup(self.codestar_connection_arn_secret_id),
+                cache=False,
+            )
         else:
             codestar_connection = codestarconnections.CfnConnection(
                 self,
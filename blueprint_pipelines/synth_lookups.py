@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from aws_cdk import core as cdk
+
+DEFAULT_CACHE_FILE = "synth-lookups.context.json"
+DEFAULT_TTL_SECONDS = 3600
+MAX_CONCURRENT_LOOKUPS = 8
+
+logger = logging.getLogger(__name__)
+
+
+class SynthLookups:
+    """Runs the AWS API calls made at synth time concurrently and caches their
+    results in a local file.
+
+    Lookups are started by add and their results read with get, so adding
+    every lookup of a stack up front runs them all at once. Cached results are
+    reused for the synthLookupsTtlSeconds context value (an hour by default),
+    from the synthLookupsCacheFile context value if set.
+    With the synthLookupsOffline context value, cached results are always
+    reused, whatever their age, and a lookup that isn't cached fails instead
+    of calling AWS."""
+
+    # Shared by every stack of the app, so each cache file is only read once
+    _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOOKUPS)
+    _caches = {}
+    _lock = threading.Lock()
+
+    def __init__(self, scope: cdk.Construct, cache_file: str = None):
+        self.cache_file = (
+            cache_file
+            or scope.node.try_get_context("synthLookupsCacheFile")
+            or DEFAULT_CACHE_FILE
+        )
+        ttl_seconds = scope.node.try_get_context("synthLookupsTtlSeconds")
+        # 0 is a valid TTL, which refreshes every lookup
+        self.ttl_seconds = float(
+            DEFAULT_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        )
+        self.offline = str(
+            scope.node.try_get_context("synthLookupsOffline")
+        ).lower() in ("true", "1")
+        account = cdk.Stack.of(scope).account
+        if cdk.Token.is_unresolved(account):
+            account = os.environ.get("CDK_DEFAULT_ACCOUNT", "default")
+        self.key_prefix = f"{account}/{boto3.session.Session().region_name}/"
+        self.futures = {}
+        self.values = {}
+        self.uncached = set()
+
+    def cache(self) -> dict:
+        with self._lock:
+            if self.cache_file not in self._caches:
+                try:
+                    with open(self.cache_file, encoding="utf-8") as fp:
+                        self._caches[self.cache_file] = json.load(fp)
+                except FileNotFoundError:
+                    self._caches[self.cache_file] = {}
+            return self._caches[self.cache_file]
+
+    def add(self, name: str, lookup, cache: bool = True):
+        """Start the lookup, unless it's cached. lookup is called with a boto3
+        session of its own, since sessions can't be shared between threads.
+
+        Results of lookups added with cache=False, such as secrets, are only
+        kept in memory and never written to the cache file. They are read from
+        it only when offline, e.g. to synthesize with a stub value."""
+        if name in self.futures:
+            return
+        if not cache:
+            self.uncached.add(name)
+        cached = self.cache().get(self.key_prefix + name)
+        if cached is not None and (
+            self.offline
+            or (cache and time.time() - cached["fetched_at"] < self.ttl_seconds)
+        ):
+            self.futures[name] = None
+            return
+        if self.offline and not cache:
+            raise ValueError(
+                f"Synth lookup {name} is never cached, add it to {self.cache_file} "
+                "to synthesize with synthLookupsOffline"
+            )
+        if self.offline:
+            raise ValueError(
+                f"Synth lookup {name} is not cached in {self.cache_file}, synthesize "
+                "once without synthLookupsOffline to cache it"
+            )
+        self.futures[name] = self._executor.submit(lookup, boto3.session.Session())
+
+    def get(self, name: str, lookup=None, cache: bool = True):
+        """Return the result of the lookup, adding it first if it wasn't."""
+        if lookup is not None:
+            self.add(name, lookup, cache)
+        if name in self.values:
+            return self.values[name]
+        key = self.key_prefix + name
+        future = self.futures[name]
+        if future is None:
+            value = self.cache()[key]["value"]
+        else:
+            value = future.result()
+            self.update_cache(key, value, name not in self.uncached)
+        # Later gets return the value rather than wait on the future again
+        self.values[name] = value
+        return value
+
+    def update_cache(self, key: str, value, persist: bool):
+        cache = self.cache()
+        with self._lock:
+            if persist:
+                cache[key] = {"value": value, "fetched_at": time.time()}
+            # Drops results that shouldn't be persisted, written by earlier
+            # versions of the cache
+            elif cache.pop(key, None) is None:
+                return
+            with open(self.cache_file, "w", encoding="utf-8") as fp:
+                json.dump(cache, fp, indent=2, sort_keys=True)
+
+
+def lookup_guardduty_detector_ids(session):
+    return session.client("guardduty").list_detectors().get("DetectorIds", [])
+
+
+def lookup_macie_status(session):
+    try:
+        return session.client("macie2").get_macie_session().get("status")
+    except Exception as e:
+        if "Macie is not enabled" not in str(e):
+            raise
+        return None
+
+
+def lookup_access_analyzer_statuses(session):
+    return [
+        analyzer.get("status")
+        for analyzer in session.client("accessanalyzer")
+        .list_analyzers()
+        .get("analyzers", [{}])
+    ]
+
+
+def secret_string_lookup(secret_id: str):
+    def lookup(session):
+        return session.client("secretsmanager").get_secret_value(SecretId=secret_id)[
+            "SecretString"
+        ]
+
+    return lookup
@@ -0,0 +1,200 @@
+import collections
+import contextlib
+import functools
+import json
+import sys
+import time
+
+from aws_cdk import (
+    core as cdk,
+    aws_lambda,
+    aws_lambda_python,
+    aws_s3_assets,
+)
+
+# Constructs whose constructors stage an asset, which fingerprints it and, for
+# PythonFunction, bundles it with its requirements
+ASSET_CONSTRUCTS = [
+    ("asset", aws_s3_assets.Asset),
+    ("asset", aws_lambda.Function),
+    ("asset", aws_lambda.LayerVersion),
+    ("bundling", aws_lambda_python.PythonFunction),
+]
+CONSTRUCT_TYPES_REPORTED = 10
+BAR_WIDTH = 40
+
+
+class Frame:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.children = collections.OrderedDict()
+
+    def child(self, name: str) -> "Frame":
+        if name not in self.children:
+            self.children[name] = Frame(name)
+        return self.children[name]
+
+    def self_seconds(self) -> float:
+        return self.seconds - sum(child.seconds for child in self.children.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "calls": self.calls,
+            "children": [child.to_dict() for child in self.children.values()],
+        }
+
+
+class SynthProfiler:
+    """Times the parts of a synth, nested as they call each other.
+
+    Enabled with the synthProfile context value, the file the profile is
+    written to as JSON. It times the constructors and configure_* methods of
+    the stacks, asset staging and bundling, ConstructNode.find_all and
+    app.synth, and counts the constructs of each stack. Disabled, it does
+    nothing."""
+
+    def __init__(self, output_file: str = None) -> None:
+        self.output_file = output_file
+        self.root = Frame("synth")
+        self.frames = [self.root]
+        self.patches = []
+
+    @classmethod
+    def from_context(cls, app: cdk.App, stack_classes: list) -> "SynthProfiler":
+        profiler = cls(app.node.try_get_context("synthProfile"))
+        if profiler.output_file:
+            profiler.install(stack_classes)
+        return profiler
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        if not self.output_file:
+            yield
+            return
+        frame = self.frames[-1].child(name)
+        self.frames.append(frame)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            frame.seconds += time.perf_counter() - started_at
+            frame.calls += 1
+            self.frames.pop()
+
+    def wrap(self, owner, attribute: str, name: str):
+        function = getattr(owner, attribute)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with self.timed(name):
+                return function(*args, **kwargs)
+
+        setattr(owner, attribute, timed)
+        self.patches.append((owner, attribute, function))
+
+    def install(self, stack_classes: list):
+        # The configure_* methods of the stacks and of their mixins
+        wrapped = set()
+        for stack_class in stack_classes:
+            self.wrap(stack_class, "__init__", f"{stack_class.__name__}.__init__")
+            for cls in stack_class.__mro__:
+                if cls.__module__.startswith(("aws_cdk", "jsii", "builtins")):
+                    continue
+                for attribute in vars(cls):
+                    if (
+                        attribute.startswith("configure_")
+                        and (cls, attribute) not in wrapped
+                    ):
+                        self.wrap(cls, attribute, f"{cls.__name__}.{attribute}")
+                        wrapped.add((cls, attribute))
+        for kind, construct_class in ASSET_CONSTRUCTS:
+            self.wrap(
+                construct_class,
+                "__init__",
+                f"{kind}: {construct_class.__module__.split('.')[-1]}.{construct_class.__name__}",
+            )
+        self.wrap(cdk.ConstructNode, "find_all", "ConstructNode.find_all")
+
+    def uninstall(self):
+        for owner, attribute, function in reversed(self.patches):
+            setattr(owner, attribute, function)
+        self.patches = []
+
+    def folded(self) -> list:
+        """Return the frames as folded stacks of self time in microseconds, the
+        input format of flame graph tools."""
+        lines = []
+
+        def fold(frame, path):
+            path = path + [frame.name]
+            microseconds = int(frame.self_seconds() * 1e6)
+            if microseconds > 0:
+                lines.append(f"{';'.join(path)} {microseconds}")
+            for child in frame.children.values():
+                fold(child, path)
+
+        fold(self.root, [])
+        return lines
+
+    def summary(self) -> str:
+        lines = []
+        total = self.root.seconds or 1
+
+        def describe(frame, depth):
+            share = frame.seconds / total
+            lines.append(
+                f"{frame.seconds * 1000:10.1f} ms {share:6.1%} "
+                f"{'#' * round(share * BAR_WIDTH):<{BAR_WIDTH}} "
+                f"{'  ' * depth}{frame.name}"
+                + (f" x{frame.calls}" if frame.calls > 1 else "")
+            )
+            for child in sorted(
+                frame.children.values(), key=lambda child: -child.seconds
+            ):
+                describe(child, depth + 1)
+
+        describe(self.root, 0)
+        return "\n".join(lines)
+
+    @staticmethod
+    def construct_counts(app: cdk.App) -> dict:
+        counts = {}
+        for stack in app.node.children:
+            if not isinstance(stack, cdk.Stack):
+                continue
+            constructs = stack.node.find_all()
+            types = collections.Counter(
+                type(construct).__name__ for construct in constructs
+            )
+            counts[stack.node.id] = {
+                "constructs": len(constructs),
+                "types": dict(types.most_common(CONSTRUCT_TYPES_REPORTED)),
+            }
+        return counts
+
+    def report(self, app: cdk.App):
+        """Write the profile and print a summary of it, if enabled."""
+        if not self.output_file:
+            return
+        self.uninstall()
+        self.root.seconds = sum(child.seconds for child in self.root.children.values())
+        self.root.calls = 1
+        construct_counts = self.construct_counts(app)
+        with open(self.output_file, "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "total_seconds": self.root.seconds,
+                    "profile": self.root.to_dict(),
+                    "folded": self.folded(),
+                    "construct_counts": construct_counts,
+                },
+                fp,
+                indent=2,
+            )
+        print(self.summary(), file=sys.stderr)
+        for stack_id, counts in construct_counts.items():
+            print(f"{stack_id}: {counts['constructs']} constructs", file=sys.stderr)
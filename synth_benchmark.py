@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.root.setLevel(logging.INFO)
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(CURRENT_DIR, "app.py")
+CDK_JSON_PATH = os.path.join(CURRENT_DIR, "cdk.json")
+DEFAULT_OUTPUT_FILE = "synth_benchmark.json"
+STUB_ACCOUNT = "111111111111"
+STUB_REGION = "us-east-1"
+# Results of the synth-time AWS lookups, served from the lookups cache so the
+# benchmark never calls AWS. None of the resources exist yet, so every
+# configure_* method creates all of its constructs.
+STUB_LOOKUPS = {
+    "guardduty_detector_ids": [],
+    "macie_status": None,
+    "access_analyzer_statuses": [],
+    "secret/VRCodeStarConnectionLabConnectionArn": (
+        f"arn:aws:codestar-connections:{STUB_REGION}:{STUB_ACCOUNT}:"
+        "connection/00000000-0000-0000-0000-000000000000"
+    ),
+}
+# Phases shorter than this in the baseline are too noisy to compare
+MIN_COMPARED_PHASE_SECONDS = 0.05
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=CURRENT_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=CURRENT_DIR)
+    return commit + "-dirty" if dirty.returncode else commit
+
+
+def write_stub_lookups(cache_file):
+    with open(cache_file, "w", encoding="utf-8") as fp:
+        json.dump(
+            {
+                f"{STUB_ACCOUNT}/{STUB_REGION}/{name}": {
+                    "value": value,
+                    "fetched_at": 0,
+                }
+                for name, value in STUB_LOOKUPS.items()
+            },
+            fp,
+        )
+
+
+def synth_env(work_dir, cache_file, profile_file):
+    """Return the environment the cdk CLI would run app.py with, with the
+    lookups served from cache_file and the synth profiled to profile_file."""
+    with open(CDK_JSON_PATH, encoding="utf-8") as fp:
+        context = json.load(fp).get("context", {})
+    context.update(
+        {
+            "synthLookupsOffline": "true",
+            "synthLookupsCacheFile": cache_file,
+            "synthProfile": profile_file,
+        }
+    )
+    env = dict(os.environ)
+    env.update(
+        {
+            "CDK_CONTEXT_JSON": json.dumps(context),
+            "CDK_OUTDIR": os.path.join(work_dir, "cdk.out"),
+            "CDK_DEFAULT_ACCOUNT": STUB_ACCOUNT,
+            "CDK_DEFAULT_REGION": STUB_REGION,
+            "AWS_DEFAULT_REGION": STUB_REGION,
+        }
+    )
+    return env
+
+
+def flatten_profile(frame, path=(), phases=None):
+    """Return the seconds of each frame of the profile by its path."""
+    phases = {} if phases is None else phases
+    path = path + (frame["name"],)
+    phases[";".join(path)] = frame["seconds"]
+    for child in frame["children"]:
+        flatten_profile(child, path, phases)
+    return phases
+
+
+def run_synth():
+    work_dir = tempfile.mkdtemp(prefix="synth-benchmark-")
+    try:
+        cache_file = os.path.join(work_dir, "synth-lookups.context.json")
+        profile_file = os.path.join(work_dir, "synth-profile.json")
+        write_stub_lookups(cache_file)
+        started_at = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, APP_PATH],
+            cwd=CURRENT_DIR,
+            env=synth_env(work_dir, cache_file, profile_file),
+            capture_output=True,
+            text=True,
+        )
+        wall_seconds = time.perf_counter() - started_at
+        if process.returncode != 0:
+            logger.error("app.py failed:\n%s", process.stderr)
+            sys.exit(process.returncode)
+        with open(profile_file, encoding="utf-8") as fp:
+            profile = json.load(fp)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "wall_seconds": wall_seconds,
+        "phases": flatten_profile(profile["profile"]),
+        "construct_counts": profile["construct_counts"],
+    }
+
+
+def find_regressions(result, baseline_file, max_regression):
+    """Return the phases, and "wall" for the whole synth, whose median time
+    regressed past max_regression."""
+    with open(baseline_file, encoding="utf-8") as fp:
+        baseline = json.load(fp)
+    compared = [
+        ("wall", baseline["median_wall_seconds"], result["median_wall_seconds"])
+    ]
+    compared += [
+        (phase, baseline_seconds, result["phases"][phase])
+        for phase, baseline_seconds in baseline["phases"].items()
+        if phase in result["phases"] and baseline_seconds >= MIN_COMPARED_PHASE_SECONDS
+    ]
+    regressions = []
+    for phase, baseline_seconds, seconds in compared:
+        change = seconds / baseline_seconds - 1
+        if change > max_regression:
+            logger.error(
+                "%s: median time regressed by %.0f%% (%.3fs -> %.3fs)",
+                phase,
+                change * 100,
+                baseline_seconds,
+                seconds,
+            )
+            regressions.append(phase)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark synthesizing app.py, with stubbed AWS lookups."
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Number of synths to run")
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT_FILE,
+        help="File to write the benchmark results to as JSON",
+    )
+    parser.add_argument(
+        "--history",
+        help="File to append the commit and median synth time to, one JSON line per benchmark",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Results file of a previous benchmark to compare median times with",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="Fraction by which a phase may be slower than the baseline before failing",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = []
+    for i in range(args.repeat):
+        runs.append(run_synth())
+        logger.info("Synth %s/%s: %.3fs", i + 1, args.repeat, runs[-1]["wall_seconds"])
+    result = {
+        "commit": current_commit(),
+        "repeat": args.repeat,
+        "median_wall_seconds": statistics.median(run["wall_seconds"] for run in runs),
+        "phases": {
+            phase: statistics.median(run["phases"].get(phase, 0) for run in runs)
+            for phase in runs[0]["phases"]
+        },
+        "construct_counts": runs[0]["construct_counts"],
+        "runs": [
+            {"wall_seconds": run["wall_seconds"], "phases": run["phases"]}
+            for run in runs
+        ],
+    }
+    for phase, seconds in result["phases"].items():
+        logger.info("%8.3fs %s", seconds, phase)
+    logger.info(
+        "%s: median synth %.3fs, %s constructs",
+        result["commit"],
+        result["median_wall_seconds"],
+        sum(counts["constructs"] for counts in result["construct_counts"].values()),
+    )
+    with open(args.output, "w", encoding="utf-8") as fp:
+        json.dump(result, fp, indent=2)
+    logger.info("Wrote benchmark results to %s", args.output)
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as fp:
+            fp.write(
+                json.dumps(
+                    {
+                        "commit": result["commit"],
+                        "benchmarked_at": time.strftime(
+                            "%Y-%m-%dT%H:%M:%SZ", time.gmtime()
+                        ),
+                        "median_wall_seconds": result["median_wall_seconds"],
+                        "constructs": sum(
+                            counts["constructs"]
+                            for counts in result["construct_counts"].values()
+                        ),
+                    }
+                )
+                + "\n"
+            )
+    if args.baseline and find_regressions(result, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()